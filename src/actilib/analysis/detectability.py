@@ -1,7 +1,12 @@
-import math
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import threading
 import numpy as np
 from scipy.interpolate import RectBivariateSpline
-from actilib.helpers.math import get_polar_mesh
+from scipy.optimize import curve_fit
+from scipy.special import erf, j0
+from actilib.helpers.math import get_polar_mesh, integrate_uniform
 
 
 def get_dprime_default_params():
@@ -15,7 +20,8 @@ def get_dprime_default_params():
         "view_pixel_size_mm": 0.2,   # pixel size for the display (monitor resolution)
         "view_zoom": 1,              # magnification factor to simulate display
         "view_distance_mm": 400,     #
-        "view_model": 'NPW'          # ['NPW', 'NPWE']
+        "view_model": 'NPW',         # ['NPW', 'NPWE']
+        "nps_resampling": '2D'       # ['2D', 'linear', 'radial'] - 'radial' enables the 1D radial integration of d'
     }
 
 
@@ -26,20 +32,21 @@ def calculate_radial_mesh(params):
     return mesh_r
 
 
-def calculate_task_image(params):
-    mesh_r = calculate_radial_mesh(params)
+def calculate_task_image(params, mesh_r=None):
+    mesh_r = calculate_radial_mesh(params) if mesh_r is None else mesh_r
     radius = params['task_diameter_mm'] / 2.0
     if params['task_profile'] == 'Flat':
         task = np.zeros(mesh_r.shape)
         task[mesh_r <= radius] = params['task_contrast_hu']
     elif params['task_profile'] == 'Gaussian':
-        task = (params['task_contrast_hu'] / 2) * (1 - math.erf((mesh_r - radius) / params['task_profile_coeff']))
+        task = (params['task_contrast_hu'] / 2) * (1 - erf((mesh_r - radius) / params['task_profile_coeff']))
     elif params['task_profile'] == 'Ogive':
-        task = ((1 - ((mesh_r / radius) ** 2)) ** params['task_profile_coeff']) * params['task_contrast_hu']
+        task = np.clip(1 - ((mesh_r / radius) ** 2), 0, None) ** params['task_profile_coeff']
+        task = task * params['task_contrast_hu']
         task[mesh_r > radius] = 0
     else:
         print('Profile type "' + params['task_profile'] + '" not supported, defaulting to "Flat"')
-        task = calculate_task_image(dict(params, profile='Flat'))
+        task = calculate_task_image(dict(params, task_profile='Flat'), mesh_r)
     return task
 
 
@@ -49,24 +56,70 @@ def resample_2d_ttf(data_freq, data_ttf, dest_freq):
     return np.interp(mesh_r, data_freq['ttf_f'], data_ttf['ttf'], 0, 0)  # linear by definition
 
 
-def resample_2d_nps(data_freq, data_nps, dest_freq, mode='2D'):
-    """Resample a NPS array to match a meshgrid"""
+# resampled NPS arrays and fitted interpolators, see resample_2d_nps()
+NPS_RESAMPLING_CACHE_SIZE = 64
+_nps_resampling_cache = OrderedDict()
+_nps_resampling_cache_lock = threading.Lock()  # the cache is shared by the threads of calculate_dprime_table()
+
+
+def clear_nps_resampling_cache():
+    with _nps_resampling_cache_lock:
+        _nps_resampling_cache.clear()
+
+
+def _get_cached_nps_item(key, data_nps, factory):
+    # NPS results are identified by their data objects: the cache keeps a reference to them so that their ids cannot
+    # be reused while the entry exists, and the entry is discarded if the result dictionary got new arrays
+    references = (data_nps['nps_1d'], data_nps['nps_2d'])
+    key = (id(references[0]), id(references[1]), data_nps['noise']) + key
+    with _nps_resampling_cache_lock:
+        cached = _nps_resampling_cache.get(key)
+        if cached is not None and all(c is r for c, r in zip(cached[0], references)):
+            _nps_resampling_cache.move_to_end(key)
+            return cached[1]
+    item = factory()  # outside the lock: two threads may compute the same item, the last one is kept
+    with _nps_resampling_cache_lock:
+        _nps_resampling_cache[key] = (references, item)
+        _nps_resampling_cache.move_to_end(key)
+        while len(_nps_resampling_cache) > NPS_RESAMPLING_CACHE_SIZE:
+            _nps_resampling_cache.popitem(last=False)
+    return item
+
+
+def _resample_2d_nps(data_freq, data_nps, dest_freq, mode):
     if mode == 'radial':
         mesh_a, mesh_r = get_polar_mesh(dest_freq)
         nps_resampled = np.interp(mesh_r, data_freq['nps_f'], data_nps['nps_1d'], 0, 0)  # linear by definition
-    else:  # default equivalent to mode == '2D'
-        r = RectBivariateSpline(data_freq['nps_fx'], data_freq['nps_fy'], data_nps['nps_2d'])
+    else:  # default equivalent to mode == '2D' (bicubic spline), 'linear' is a bilinear spline
+        degree = 1 if mode == 'linear' else 3
+        r = _get_cached_nps_item(('spline', degree), data_nps, lambda: RectBivariateSpline(
+            data_freq['nps_fx'], data_freq['nps_fy'], data_nps['nps_2d'], kx=degree, ky=degree))
         nps_resampled = r(dest_freq, dest_freq)
     # Scale the NPS as needed to maintain the noise variance from the original NPS
     freq_spacing = dest_freq[1] - dest_freq[0]
     scale_factor = (data_nps['noise'] ** 2) / (np.sum(nps_resampled) * (freq_spacing ** 2))
     nps_resampled = scale_factor * nps_resampled
+    nps_resampled.setflags(write=False)  # shared by all the callers through the cache
     return nps_resampled
 
 
-def get_eye_filter(params, freq_1d=None):
-    task_npx, task_psize = params['task_pixel_number'], params['task_pixel_size_mm']
+def resample_2d_nps(data_freq, data_nps, dest_freq, mode='2D'):
+    """
+    Resample a NPS array to match a meshgrid
+
+    Modes: '2D' (bicubic spline, default), 'linear' (bilinear, cheaper) or 'radial' (from the 1D NPS).
+    Fitted splines and resampled arrays are cached per NPS result, mode and destination grid, so the returned array
+    is read-only.
+    """
+    dest_freq = np.asarray(dest_freq)
+    dest_key = ('resampled', mode, dest_freq.size, dest_freq[0], dest_freq[-1])
+    return _get_cached_nps_item(dest_key, data_nps, lambda: _resample_2d_nps(data_freq, data_nps, dest_freq, mode))
+
+
+def get_radial_eye_filter(params, freq_r):
+    """Eye filter evaluated at the given radial frequencies, normalized to its maximum over them"""
     if params['view_model'] == 'NPWE':
+        task_npx, task_psize = params['task_pixel_number'], params['task_pixel_size_mm']
         # the following three parameters are hardcoded because nobody is actually changing them (except c, in one paper)
         n = 1.5
         c = 3.22  # deg^-1
@@ -74,33 +127,260 @@ def get_eye_filter(params, freq_1d=None):
         distance_mm = params['view_distance_mm']  # mm, visual distance
         fov_mm = task_npx * task_psize  # (!) TASK PXSIZE
         display_mm = params['view_zoom'] * task_npx * params["view_pixel_size_mm"]  # (!) VIEW PXSIZE
-        freq_1d = freq_1d if freq_1d is not None else np.fft.fftshift(np.fft.fftfreq(task_npx, task_psize))
-        freq_2d_a, freq_2d_r = get_polar_mesh(freq_1d)
-        rho = freq_2d_r * fov_mm * distance_mm * np.pi / display_mm / 180
+        rho = freq_r * fov_mm * distance_mm * np.pi / display_mm / 180
         filter = np.power(rho, 2*n) * np.exp(-c * 2 * np.power(rho, a))
         return filter / np.max(filter)
+    return np.ones(np.shape(freq_r))
+
+
+def get_eye_filter(params, freq_1d=None):
+    task_npx, task_psize = params['task_pixel_number'], params['task_pixel_size_mm']
+    if params['view_model'] == 'NPWE':
+        freq_1d = freq_1d if freq_1d is not None else np.fft.fftshift(np.fft.fftfreq(task_npx, task_psize))
+        freq_2d_a, freq_2d_r = get_polar_mesh(freq_1d)
+        return get_radial_eye_filter(params, freq_2d_r)
     return np.ones((task_npx, task_npx))
 
 
-def calculate_dprime(data_nps, data_ttf, params=get_dprime_default_params()):
-    data_freq = {
+def get_data_freq(data_nps, data_ttf):
+    return {
         'nps_fx': data_nps['f2d_x'],
         'nps_fy': data_nps['f2d_y'],
         'nps_f': data_nps['f1d'],
         'ttf_f': data_ttf['frq']
     }
-    task_image = calculate_task_image(params)
+
+
+def calculate_task_freq(task_images, params):
+    """Fourier transform of one task image or of a stack of them (transform on the last two axes)"""
     pixel_size_sq = params['task_pixel_size_mm'] ** 2
-    task_freq = np.fft.fftshift(abs(pixel_size_sq * np.fft.fftn(task_image)))
-    freq_1d = np.fft.fftshift(np.fft.fftfreq(params['task_pixel_number'], params['task_pixel_size_mm']))
-    ttf_resampled = resample_2d_ttf(data_freq, data_ttf, freq_1d)
-    nps_resampled = resample_2d_nps(data_freq, data_nps, freq_1d)
-    eye_filter = get_eye_filter(params, freq_1d)
+    return np.fft.fftshift(abs(pixel_size_sq * np.fft.fft2(task_images)), axes=(-2, -1))
+
+
+def calculate_dprime_from_spectra(task_freq, ttf_resampled, nps_resampled, eye_filter, params):
+    """d' from resampled spectra. task_freq may have leading axes (a stack of tasks), the result then has them too"""
     internal_noise = np.zeros(params['task_pixel_number'])  # TODO implement noise calculation instead of null matrix
     freq_spacing_coeff = (1.0 / (params['task_pixel_size_mm'] * params['task_pixel_number'])) ** 2
-    # finally, the d' calculation
     common = task_freq ** 2 * (ttf_resampled ** 2)
-    numerator = np.sum(common * (eye_filter ** 2)) * freq_spacing_coeff
-    denominator = math.sqrt(np.sum(common * (eye_filter ** 4) * nps_resampled + internal_noise) * freq_spacing_coeff)
+    numerator = np.sum(common * (eye_filter ** 2), axis=(-2, -1)) * freq_spacing_coeff
+    denominator = np.sqrt(np.sum(common * (eye_filter ** 4) * nps_resampled + internal_noise, axis=(-2, -1))
+                          * freq_spacing_coeff)
     return numerator / denominator
 
+
+def calculate_radial_task_freq(params, freq_r, radial_oversampling=4):
+    """Fourier transform of the (rotationally symmetric) task as a 1D Hankel transform of its radial profile"""
+    fov_mm = params['task_pixel_number'] * params['task_pixel_size_mm']
+    radius_step = params['task_pixel_size_mm'] / radial_oversampling
+    radii = np.arange(0, fov_mm / 2.0, radius_step)
+    profile = calculate_task_image(params, radii)
+    kernel = j0(2 * np.pi * np.outer(freq_r, radii)) * (radii * profile)
+    return np.abs(2 * np.pi * integrate_uniform(kernel, radius_step))
+
+
+def is_radial_dprime_possible(params):
+    return params.get('nps_resampling', '2D') == 'radial' and params['task_profile'] in ['Flat', 'Gaussian', 'Ogive']
+
+
+@lru_cache(maxsize=16)
+def get_frequency_annuli(task_pixel_number, task_pixel_size_mm, freq_oversampling=4):
+    """
+    Group the points of the 2D frequency grid of the task in thin annuli.
+
+    :return: the mean radial frequency of the points in each non-empty annulus and the number of points in it
+    """
+    freq_1d = np.fft.fftshift(np.fft.fftfreq(task_pixel_number, task_pixel_size_mm))
+    _, freq_2d_r = get_polar_mesh(freq_1d)
+    annulus_width = (freq_1d[1] - freq_1d[0]) / freq_oversampling
+    annulus_index = (freq_2d_r / annulus_width).astype(int).ravel()
+    counts = np.bincount(annulus_index)
+    sums = np.bincount(annulus_index, weights=freq_2d_r.ravel())
+    non_empty = counts > 0
+    return sums[non_empty] / counts[non_empty], counts[non_empty]
+
+
+def calculate_radial_spectra(data_nps, data_ttf, params):
+    """Annuli of the frequency plane (see get_frequency_annuli()) with the TTF, NPS and eye filter resampled on them"""
+    freq_r, weights = get_frequency_annuli(params['task_pixel_number'], params['task_pixel_size_mm'])
+    ttf_resampled = np.interp(freq_r, data_ttf['frq'], data_ttf['ttf'], 0, 0)
+    nps_resampled = np.interp(freq_r, data_nps['f1d'], data_nps['nps_1d'], 0, 0)
+    freq_spacing_coeff = (1.0 / (params['task_pixel_size_mm'] * params['task_pixel_number'])) ** 2
+    nps_resampled = nps_resampled * (data_nps['noise'] ** 2) / (np.sum(weights * nps_resampled) * freq_spacing_coeff)
+    return freq_r, weights, ttf_resampled, nps_resampled, get_radial_eye_filter(params, freq_r)
+
+
+def calculate_dprime_from_radial_spectra(radial_spectra, params):
+    freq_r, weights, ttf_resampled, nps_resampled, eye_filter = radial_spectra
+    freq_spacing_coeff = (1.0 / (params['task_pixel_size_mm'] * params['task_pixel_number'])) ** 2
+    # the task spectrum is needed only where the TTF does not vanish
+    task_freq = np.zeros(freq_r.shape)
+    in_band = ttf_resampled != 0
+    task_freq[in_band] = calculate_radial_task_freq(params, freq_r[in_band])
+    common = weights * task_freq ** 2 * (ttf_resampled ** 2)
+    numerator = np.sum(common * (eye_filter ** 2)) * freq_spacing_coeff
+    denominator = np.sqrt(np.sum(common * (eye_filter ** 4) * nps_resampled) * freq_spacing_coeff)
+    return float(numerator / denominator)
+
+
+def calculate_dprime_radial(data_nps, data_ttf, params=get_dprime_default_params()):
+    """
+    Calculate d' with 1D sums over annuli of the frequency plane, weighted by their number of 2D grid points.
+
+    Valid when the task, the TTF, the eye filter and the (radially resampled) NPS are all rotationally symmetric:
+    it reproduces the 2D calculation with nps_resampling='radial' within a few percent (the difference comes from
+    the pixelation of the 2D task image) without building any 2D grid or FFT.
+    """
+    return calculate_dprime_from_radial_spectra(calculate_radial_spectra(data_nps, data_ttf, params), params)
+
+
+def calculate_dprime(data_nps, data_ttf, params=get_dprime_default_params()):
+    if is_radial_dprime_possible(params):
+        return calculate_dprime_radial(data_nps, data_ttf, params)
+    data_freq = get_data_freq(data_nps, data_ttf)
+    task_image = calculate_task_image(params)
+    task_freq = calculate_task_freq(task_image, params)
+    freq_1d = np.fft.fftshift(np.fft.fftfreq(params['task_pixel_number'], params['task_pixel_size_mm']))
+    ttf_resampled = resample_2d_ttf(data_freq, data_ttf, freq_1d)
+    nps_resampled = resample_2d_nps(data_freq, data_nps, freq_1d, mode=params.get('nps_resampling', '2D'))
+    eye_filter = get_eye_filter(params, freq_1d)
+    # finally, the d' calculation
+    return float(calculate_dprime_from_spectra(task_freq, ttf_resampled, nps_resampled, eye_filter, params))
+
+
+def calculate_dprime_sweep(data_nps, data_ttf, task_diameters_mm, task_contrasts_hu, task_profiles=('Flat',),
+                           params=get_dprime_default_params()):
+    """
+    Calculate d' for a grid of task profiles, diameters and contrasts against one NPS/TTF pair.
+
+    NPS, TTF and eye filter are resampled only once and all the task images are transformed as a single stack.
+    With the (null) internal noise d' is proportional to the absolute task contrast, so the contrast axis is obtained
+    by scaling the d' of a unit-contrast task.
+    Profiles for which calculate_dprime() takes the radial path (see is_radial_dprime_possible()) take it here too,
+    so that the results are the same as those of calculate_dprime().
+    :return: a dictionary with the three axes labels and the 'dprime' array with shape (profiles, diameters, contrasts)
+    """
+    task_profiles = [task_profiles] if isinstance(task_profiles, str) else list(task_profiles)
+    task_diameters_mm = np.atleast_1d(np.asarray(task_diameters_mm, dtype=float))
+    task_contrasts_hu = np.atleast_1d(np.asarray(task_contrasts_hu, dtype=float))
+    dprime_unit = np.zeros((len(task_profiles), len(task_diameters_mm)))
+    radial_profiles = [profile for profile in task_profiles
+                       if is_radial_dprime_possible(dict(params, task_profile=profile))]
+    if radial_profiles:
+        radial_spectra = calculate_radial_spectra(data_nps, data_ttf, params)
+        for profile in radial_profiles:
+            dprime_unit[task_profiles.index(profile)] = [calculate_dprime_from_radial_spectra(radial_spectra, dict(
+                params, task_profile=profile, task_diameter_mm=diameter, task_contrast_hu=1.0))
+                for diameter in task_diameters_mm]
+    if len(radial_profiles) == len(task_profiles):
+        return get_dprime_sweep_result(task_profiles, task_diameters_mm, task_contrasts_hu, dprime_unit)
+    data_freq = get_data_freq(data_nps, data_ttf)
+    freq_1d = np.fft.fftshift(np.fft.fftfreq(params['task_pixel_number'], params['task_pixel_size_mm']))
+    ttf_resampled = resample_2d_ttf(data_freq, data_ttf, freq_1d)
+    nps_resampled = resample_2d_nps(data_freq, data_nps, freq_1d, mode=params.get('nps_resampling', '2D'))
+    eye_filter = get_eye_filter(params, freq_1d)
+    mesh_r = calculate_radial_mesh(params)
+    for p, profile in enumerate(task_profiles):  # one stack per profile to limit the memory footprint of the FFT
+        if profile in radial_profiles:
+            continue
+        task_images = np.stack([calculate_task_image(dict(params, task_profile=profile, task_diameter_mm=diameter,
+                                                          task_contrast_hu=1.0), mesh_r)
+                                for diameter in task_diameters_mm])
+        task_freq = calculate_task_freq(task_images, params)
+        dprime_unit[p] = calculate_dprime_from_spectra(task_freq, ttf_resampled, nps_resampled, eye_filter, params)
+    return get_dprime_sweep_result(task_profiles, task_diameters_mm, task_contrasts_hu, dprime_unit)
+
+
+def get_dprime_sweep_result(task_profiles, task_diameters_mm, task_contrasts_hu, dprime_unit):
+    return {
+        'task_profile': task_profiles,
+        'task_diameter_mm': task_diameters_mm,
+        'task_contrast_hu': task_contrasts_hu,
+        'dprime': dprime_unit[:, :, np.newaxis] * np.abs(task_contrasts_hu)[np.newaxis, np.newaxis, :]
+    }
+
+
+def _calculate_section_dprimes_job(job):
+    # all the inserts of a section in one job: the NPS is sent to the worker once and its resampling is cached there
+    data_nps, ttf_and_params = job
+    return [calculate_dprime(data_nps, data_ttf, params) for data_ttf, params in ttf_and_params]
+
+
+def calculate_dprime_table(nps_results, ttf_results, params=get_dprime_default_params(), contrast_from_ttf=True,
+                           max_workers=None, use_threads=False):
+    """
+    Calculate d' for all the combinations of inserts and sections, distributing them on a pool of workers.
+
+    :param nps_results: dictionary {section: NPS result}. Sections can be diameter keys like 'd160mm' or tuples ending
+                        with one, e.g. ('Br40', '5mGy', 'd160mm') to compare reconstructions and dose levels
+    :param ttf_results: dictionary {insert: {section: TTF result}}, the same layout as 'values_ttf'
+    :param params: d' parameters common to all the calculations
+    :param contrast_from_ttf: if True the task contrast is the 'contrast' of each TTF result
+    :param max_workers: size of the pool (None: number of processors, 1: no pool)
+    :param use_threads: use a thread pool instead of a process pool
+    :return: a list of rows {'insert', 'section', 'task_contrast_hu', 'dprime'}
+    """
+    rows, rows_by_section = [], {}
+    for insert, ttf_by_section in ttf_results.items():
+        for section, data_ttf in ttf_by_section.items():
+            if section not in nps_results:
+                continue
+            job_params = dict(params)
+            if contrast_from_ttf:
+                job_params['task_contrast_hu'] = data_ttf['contrast']
+            rows.append({'insert': insert, 'section': section, 'task_contrast_hu': job_params['task_contrast_hu']})
+            rows_by_section.setdefault(section, []).append((rows[-1], data_ttf, job_params))
+    jobs = [(nps_results[section], [(data_ttf, job_params) for _, data_ttf, job_params in section_rows])
+            for section, section_rows in rows_by_section.items()]
+    if max_workers == 1:
+        dprimes = map(_calculate_section_dprimes_job, jobs)
+    else:
+        executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+        with executor_class(max_workers=max_workers) as executor:
+            dprimes = list(executor.map(_calculate_section_dprimes_job, jobs))
+    for section_rows, section_dprimes in zip(rows_by_section.values(), dprimes):
+        for (row, _, _), dprime in zip(section_rows, section_dprimes):
+            row['dprime'] = dprime
+    return rows
+
+
+def fit_dprime_vs_diameter(diameters_mm, dprimes):
+    """
+    Fit d' = alpha * exp(beta * diameter) with non-linear least squares, as imQuest does.
+    Two diameters give the exact curve through both points, a single one gives NaN values.
+
+    :return: a dictionary with 'alpha', 'beta', 'residual' (mean absolute relative residual [%]) and 'r2'
+    """
+    diameters_mm, dprimes = np.asarray(diameters_mm, dtype=float), np.asarray(dprimes, dtype=float)
+    if len(set(diameters_mm.tolist())) < 2:
+        return {'alpha': float('nan'), 'beta': float('nan'), 'residual': float('nan'), 'r2': float('nan')}
+    beta, log_alpha = np.polyfit(diameters_mm, np.log(dprimes), 1)  # starting point from the log-linear fit
+    if len(diameters_mm) == 2:
+        return {'alpha': float(np.exp(log_alpha)), 'beta': float(beta), 'residual': 0.0, 'r2': 1.0}
+    (alpha, beta), _ = curve_fit(lambda x, a, b: a * np.exp(b * x), diameters_mm, dprimes, p0=(np.exp(log_alpha), beta))
+    residuals = dprimes - alpha * np.exp(beta * diameters_mm)
+    return {
+        'alpha': float(alpha),
+        'beta': float(beta),
+        'residual': float(100 * np.mean(np.abs(residuals) / dprimes)),
+        'r2': float(1 - np.sum(residuals ** 2) / np.sum((dprimes - np.mean(dprimes)) ** 2))
+    }
+
+
+def get_values_dprime(dprime_table):
+    """
+    Arrange the rows from calculate_dprime_table() as the 'values_dprime' structure used in helpers.imquest,
+    including the exponential fit vs the phantom diameter.
+
+    If the sections are tuples, the result is a dictionary {section[:-1]: values_dprime}.
+    """
+    grouped = {}
+    for row in dprime_table:
+        section = row['section']
+        series, diameter_key = (section[:-1], section[-1]) if isinstance(section, tuple) else (None, section)
+        insert_data = grouped.setdefault(series, {}).setdefault(row['insert'], {'dprimes': {}})
+        insert_data['dprimes'][diameter_key] = row['dprime']
+    for values_dprime in grouped.values():
+        for insert_data in values_dprime.values():
+            diameters_mm = [int(diameter_key[1:-2]) for diameter_key in insert_data['dprimes']]  # 'd260mm' -> 260
+            insert_data.update(fit_dprime_vs_diameter(diameters_mm, list(insert_data['dprimes'].values())))
+    return grouped[None] if list(grouped.keys()) == [None] else grouped
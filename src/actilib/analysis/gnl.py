@@ -1,8 +1,14 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from scipy.ndimage import generic_filter
 from scipy.signal import convolve2d
 from numpy.lib.stride_tricks import sliding_window_view
-from actilib.analysis.segmentation import SegMats, get_default_segmentation_thresholds, segment_with_thresholds
+from actilib.helpers.io import get_slice_position
+from actilib.helpers.math import get_integral_image, get_box_sums
+from actilib.analysis.segmentation import SegMats, SEG_UNASSIGNED, get_default_segmentation_thresholds, \
+    segment_with_lut, get_body_mask, get_bounding_box
 
 """
 GLN - Global Noise Level
@@ -11,14 +17,143 @@ doi: 10.2214/AJR.14.13613
 This function takes a single DICOM image (including headers) as input and calculates its GNL.
 """
 
+LOCAL_STD_MAX_VALUE = 32768.0  # no local SD of 16-bit pixel data is above half of their range
 
-def get_histogram_mode(data):
-    histo_max = int(np.nanmax(data) + 1)
-    histogram, bin_edges = np.histogram(data, bins=histo_max, range=(1, histo_max))
-    return np.argmax(histogram)  # bin size = 1 -> bin index = bin upper edge = x value
 
+def get_histogram_mode(data, bin_width=1.0, max_value=LOCAL_STD_MAX_VALUE):
+    """
+    Mode of the local SD values of a GNL map: center of the most populated bin of a LocalStdHistogram, so that single
+    slices and whole exams (calculate_volume_gnl()) follow the same convention. Zeros (pixels outside the tissues)
+    and NaN are not counted, and a map without any other value has NaN as mode.
+    """
+    return LocalStdHistogram(bin_width, max_value).add_values(data).mode()
 
-def calculate_local_std(img, kernel_size, algorithm):
+
+class LocalStdHistogram:
+    """
+    Histogram of local SD values with fixed bins, filled with bincount.
+
+    Histograms with the same binning can be merged (e.g. the slices of an exam, also from different workers), so that
+    the GNL of the whole exam is the mode of the pooled histogram. Values outside (0, max_value) are only counted: a
+    null local SD comes from a constant region (e.g. a masked ROI) or from the pixels outside the tissues of a map.
+    """
+
+    def __init__(self, bin_width=1.0, max_value=LOCAL_STD_MAX_VALUE):
+        self.bin_width = bin_width
+        self.max_value = max_value
+        self.counts = np.zeros(int(np.ceil(max_value / bin_width)), dtype=np.int64)
+        self.num_outside = 0
+
+    def add_values(self, values):
+        values = np.asarray(values)
+        values = values[np.isfinite(values)]
+        inside = values[(values > 0) & (values < self.max_value)]  # before the cast, large values would overflow
+        indexes = np.minimum((inside / self.bin_width).astype(np.int64), self.counts.size - 1)
+        self.counts += np.bincount(indexes, minlength=self.counts.size)
+        self.num_outside += int(values.size - inside.size)
+        return self
+
+    def merge(self, other):
+        if other.bin_width != self.bin_width or other.counts.size != self.counts.size:
+            raise ValueError('histograms with different binning cannot be merged')
+        self.counts += other.counts
+        self.num_outside += other.num_outside
+        return self
+
+    def num_values(self):
+        return int(np.sum(self.counts))
+
+    def mode(self):
+        """Center of the most populated bin (NaN if the histogram is empty)"""
+        if self.num_values() == 0:
+            return np.nan
+        return (np.argmax(self.counts) + 0.5) * self.bin_width
+
+
+def calculate_local_std_integral(img, kernel_size, offset=None):
+    """
+    Local SD from summed-area tables of the image and of its square: the cost does not depend on the kernel size.
+
+    Boundaries are handled as by the 'convolution' algorithm. Sums are accumulated in float64 on the image minus an
+    offset (to limit the cancellation in mean of squares minus square of mean), by default its mean rounded to an
+    integer: the sums of integer-valued images (e.g. CT numbers) are then exact. The result keeps float32 inputs
+    float32.
+    """
+    margin = kernel_size // 2
+    offset = np.round(np.mean(img, dtype=np.float64)) if offset is None else offset
+    img_centered = img - offset
+    num_pixels = kernel_size ** 2
+    local_mean = get_box_sums(get_integral_image(img_centered, margin), kernel_size, margin) / num_pixels
+    local_mean_of_sq = get_box_sums(get_integral_image(img_centered ** 2, margin), kernel_size, margin) / num_pixels
+    img_std = np.sqrt(np.clip(local_mean_of_sq - local_mean ** 2, 0, None))
+    return img_std.astype(img.dtype) if img.dtype == np.float32 else img_std
+
+
+def get_local_std_tile_size(kernel_size, algorithm, memory_budget_mb=64):
+    """Largest tile side whose local SD calculation stays (roughly) within the memory budget"""
+    if 'sliding_window_view' == algorithm:  # the std reduction allocates a float64 temporary per window pixel
+        bytes_per_pixel = 2 * 8 * kernel_size ** 2
+    else:  # a few float64 images and tables
+        bytes_per_pixel = 8 * 8
+    halo = 2 * (kernel_size // 2)
+    return max(16, int((memory_budget_mb * 2 ** 20 / bytes_per_pixel) ** 0.5) - halo)
+
+
+def calculate_local_std_tiled(img, kernel_size, algorithm, tile_size=None, memory_budget_mb=64, max_workers=1):
+    """
+    Local SD computed on overlapping tiles, to bound the memory used by large images, volumes or kernels.
+
+    The image is padded once as each algorithm would pad it, then every tile is computed on a block including a halo
+    of kernel_size // 2 pixels: the results are bit-identical to the untiled calculation. For 'integral_image' all
+    the blocks are centered on the offset of the whole image, so this holds for integer-valued images (e.g. CT
+    numbers), other images match to the rounding.
+    :param img: 2D image or 3D stack of slices (z, y, x), processed slice by slice
+    :param tile_size: side of the tiles [px], if None it is derived from memory_budget_mb
+    :param max_workers: number of threads processing the tiles
+    """
+    if img.ndim == 3:
+        return np.stack([calculate_local_std_tiled(slice_img, kernel_size, algorithm, tile_size, memory_budget_mb,
+                                                   max_workers) for slice_img in img])
+    tile_size = get_local_std_tile_size(kernel_size, algorithm, memory_budget_mb) if tile_size is None else tile_size
+    margin = kernel_size // 2
+    offset = np.round(np.mean(img, dtype=np.float64))  # for 'integral_image', the same for all the tiles
+    if 'sliding_window_view' == algorithm:
+        img_pad = np.pad(img.astype(np.float64), margin, mode='constant', constant_values=np.nan)
+    else:
+        img_pad = np.pad(img, margin, mode='symmetric')
+    tiles = [(y, x) for y in range(0, img.shape[0], tile_size) for x in range(0, img.shape[1], tile_size)]
+
+    def process_tile(tile):
+        y, x = tile
+        block = img_pad[y:y + tile_size + 2 * margin, x:x + tile_size + 2 * margin]
+        if 'integral_image' == algorithm:
+            block_std = calculate_local_std_integral(block, kernel_size, offset)
+        else:
+            block_std = calculate_local_std(block, kernel_size, algorithm)
+        return tile, block_std[margin:block.shape[0] - margin, margin:block.shape[1] - margin]
+
+    def store_tiles(results):
+        img_std = None
+        for (y, x), tile_std in results:
+            if img_std is None:
+                img_std = np.empty(img.shape, dtype=tile_std.dtype)
+            img_std[y:y + tile_std.shape[0], x:x + tile_std.shape[1]] = tile_std
+        return img_std
+
+    if max_workers == 1:
+        return store_tiles(map(process_tile, tiles))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return store_tiles(executor.map(process_tile, tiles))
+
+
+def calculate_local_std(img, kernel_size, algorithm, tile_size=None, max_workers=1):
+    """
+    Local SD on a square kernel of kernel_size pixels, with the selected algorithm.
+
+    With tile_size the calculation is split in tiles of that side, see calculate_local_std_tiled().
+    """
+    if tile_size is not None:
+        return calculate_local_std_tiled(img, kernel_size, algorithm, tile_size=tile_size, max_workers=max_workers)
     kernel_shape = (kernel_size, kernel_size)
     if 'generic_filter' == algorithm:  # probably the most accurate, but slow
         img_std = generic_filter(img, np.std, size=kernel_size)
@@ -28,19 +163,287 @@ def calculate_local_std(img, kernel_size, algorithm):
         sq_of_mean = convolve2d(img, kernel, mode='same', boundary='symm') ** 2
         img_std = np.sqrt(mean_of_sq - sq_of_mean)
     elif 'sliding_window_view' == algorithm:  # 30% fastest as convolution, but must be padded
-        margin = int((kernel_size - 1) / 2)
-        img_pad = np.full((margin + margin + img.shape[0], margin + margin + img.shape[1]), np.nan)
-        img_pad[margin:-margin, margin:-margin] = img
+        before, after = kernel_size // 2, (kernel_size - 1) // 2  # even kernels aligned as by convolve2d
+        img_pad = np.pad(img.astype(np.float64), [(before, after), (before, after)], mode='constant',
+                         constant_values=np.nan)
         img_std = sliding_window_view(img_pad, window_shape=kernel_shape).std(axis=(2, 3))
+    elif 'integral_image' == algorithm:  # the fastest, independent of the kernel size, same boundaries as convolution
+        img_std = calculate_local_std_integral(img, kernel_size)
     else:
         raise NotImplementedError('algorithm "' + algorithm + '"')
     return img_std
 
 
+def get_label_integral_images(img, segmap, labels, margin):
+    """
+    Summed-area tables (stacked over the labels) of the label masks, of the masked image and of its square.
+
+    The image is centered on its mean before accumulating; the tables serve any kernel (odd or even) up to
+    2 * margin + 1 pixels.
+    """
+    masks = np.stack([segmap == label for label in labels])
+    img_centered = img - np.mean(img, dtype=np.float64)
+    img_masked = np.where(masks, img_centered, 0)
+    return {
+        'masks': masks,
+        'margin': margin,
+        'counts': get_integral_image(masks, margin),
+        'sums': get_integral_image(img_masked, margin),
+        'sums_sq': get_integral_image(img_masked * img_centered, margin)
+    }
+
+
+def calculate_local_std_from_label_integrals(tables, kernel_size, dtype=np.float64):
+    margin = tables['margin']
+    counts = get_box_sums(tables['counts'], kernel_size, margin).clip(1, None)
+    local_mean = get_box_sums(tables['sums'], kernel_size, margin) / counts
+    local_mean_of_sq = get_box_sums(tables['sums_sq'], kernel_size, margin) / counts
+    img_std = np.sqrt(np.clip(local_mean_of_sq - local_mean ** 2, 0, None))
+    img_std[~tables['masks']] = np.nan
+    return img_std.astype(dtype) if dtype == np.float32 else img_std
+
+
+def calculate_local_std_by_label(img, segmap, labels, kernel_size):
+    """
+    Local SD of several labels of a segmentation map in a single pass.
+
+    For each label the box filters are normalized by the number of pixels of that label inside the kernel, so pixels
+    near the border of a tissue are not mixed with zeros or with other tissues. The summed-area tables of all the
+    labels are computed together, as a stack.
+    :return: array with shape (labels, y, x) with the local SD of each label on its pixels and NaN elsewhere
+    """
+    tables = get_label_integral_images(img, segmap, labels, kernel_size // 2)
+    return calculate_local_std_from_label_integrals(tables, kernel_size, img.dtype)
+
+
+def get_kernel_size_px(kernel_radius_mm, pixel_spacing_mm):
+    return 1 + np.round(2 * kernel_radius_mm / pixel_spacing_mm).astype(int)  # odd or even (e.g. 3 mm at 0.7 mm)
+
+
+def calculate_gnl_by_tissue(pixels, segmap, tissues, kernel_size_px, histogram_bin_width=1.0,
+                            histogram_max_value=LOCAL_STD_MAX_VALUE):
+    """
+    GNL map and GNL (mode of the local SD histogram) of each tissue, from calculate_local_std_by_label().
+
+    :return: a dictionary {tissue: {'gnl': mode, 'gnlmap': local SD on the tissue pixels, NaN elsewhere}}
+    """
+    gnlmaps = calculate_local_std_by_label(pixels, segmap, [tissue.value for tissue in tissues], kernel_size_px)
+    results = {}
+    for tissue, gnlmap in zip(tissues, gnlmaps):
+        results[tissue] = {
+            'gnl': get_histogram_mode(gnlmap, histogram_bin_width, histogram_max_value),
+            'gnlmap': gnlmap
+        }
+    return results
+
+
+def apply_mask_rois(pixels, mask_rois):
+    """Return a copy of the pixels with the ROIs [y1, y2, x1, x2, value] filled (e.g. image numbers, arrows...)"""
+    if mask_rois is None:
+        return pixels
+    if not isinstance(mask_rois, list):
+        mask_rois = [mask_rois]
+    pixels = pixels.copy()  # never modify the caller's image
+    for roi in mask_rois:
+        pixels[roi[0]:roi[1], roi[2]:roi[3]] = roi[4]
+    return pixels
+
+
+def get_body_window(pixels, kernel_size_px, body_mask=False):
+    """
+    Part of a slice where GNL is calculated: the bounding box of the body enlarged by the kernel radius, as a tuple of
+    slices, and the body mask inside it. Without body_mask the window is the whole slice and the mask is None.
+    """
+    if not body_mask:
+        return (slice(None), slice(None)), None
+    mask = get_body_mask(pixels)
+    window = get_bounding_box(mask, margin=kernel_size_px // 2)
+    if window is None:  # no body at all: nothing will be segmented
+        return (slice(None), slice(None)), mask
+    return window, mask[window]
+
+
+def uncrop_map(cropped_map, shape, window, fill_value):
+    """Place a map calculated on a window of a slice in a full-size map"""
+    full_map = np.full(shape, fill_value, dtype=cropped_map.dtype)
+    full_map[window] = cropped_map
+    return full_map
+
+
+def calculate_slice_gnl(pixels, pixel_spacing_mm, tissues, kernel_radius_mm, hu_ranges, mask_rois, algorithm,
+                        body_mask=False, histogram_bin_width=1.0, histogram_max_value=LOCAL_STD_MAX_VALUE):
+    """
+    GNL of one slice: returns the mode of the local SD histogram, the segmentation map and the GNL map.
+    With body_mask, segmentation and local SD are restricted to the patient body (see get_body_mask()).
+    The histogram has bins of histogram_bin_width up to histogram_max_value, see LocalStdHistogram.
+    """
+    # 0. masking ROIs (e.g. image numbers, arrows...) and body contour
+    pixels = apply_mask_rois(pixels, mask_rois)
+    kernel_size_px = get_kernel_size_px(kernel_radius_mm, pixel_spacing_mm)
+    window, body = get_body_window(pixels, kernel_size_px, body_mask)
+    crop = pixels[window]
+    # 1. threshold-based segmentation
+    segmap = segment_with_lut(crop, hu_ranges, mask=body)
+    # 2. calculation of local SD - even kernels are aligned as by convolve2d(mode='same')
+    if [None] != tissues and 'masked_integral_image' == algorithm:  # tissue borders not mixed with other pixels
+        gnlmap = np.zeros(segmap.shape)
+        for tissue, result in calculate_gnl_by_tissue(crop, segmap, tissues, kernel_size_px, histogram_bin_width,
+                                                      histogram_max_value).items():
+            gnlmap = np.where(segmap == tissue.value, result['gnlmap'], gnlmap)
+    elif [None] != tissues:
+        gnlmap = np.zeros(segmap.shape)
+        for tissue in tissues:
+            img_segm = np.where(segmap == tissue.value, crop, 0)
+            img_gnl = calculate_local_std(img_segm, kernel_size_px, algorithm)
+            gnlmap = np.where(segmap == tissue.value, img_gnl, gnlmap)
+    else:
+        gnlmap = calculate_local_std(crop, kernel_size_px, algorithm.replace('masked_', ''))
+        if body is not None:
+            gnlmap = np.where(body, gnlmap, 0)
+    segmap = uncrop_map(segmap, pixels.shape, window, SEG_UNASSIGNED)
+    gnlmap = uncrop_map(gnlmap, pixels.shape, window, 0)
+    # 3. histogram of local SD and mode
+    return get_histogram_mode(gnlmap, histogram_bin_width, histogram_max_value), pixels, segmap, gnlmap
+
+
+def calculate_slice_gnl_histograms(pixels, pixel_spacing_mm, tissues, kernel_radius_mm, hu_ranges, mask_rois,
+                                   algorithm, histogram_bin_width=1.0, histogram_max_value=LOCAL_STD_MAX_VALUE,
+                                   body_mask=False):
+    """
+    Histograms of the local SD of each tissue of one slice, as a dictionary {tissue: LocalStdHistogram}.
+    As in calculate_slice_gnl(), tissues=[None] uses all the pixels (of the body, with body_mask) without segmentation.
+    """
+    pixels = apply_mask_rois(pixels, mask_rois)
+    kernel_size_px = get_kernel_size_px(kernel_radius_mm, pixel_spacing_mm)
+    window, body = get_body_window(pixels, kernel_size_px, body_mask)
+    pixels = pixels[window]
+    if [None] == tissues:
+        gnlmap = calculate_local_std(pixels, kernel_size_px, algorithm.replace('masked_', ''))
+        if body is not None:
+            gnlmap = np.where(body, gnlmap, np.nan)
+        return {None: LocalStdHistogram(histogram_bin_width, histogram_max_value).add_values(gnlmap)}
+    segmap = segment_with_lut(pixels, hu_ranges, mask=body)
+    if 'masked_integral_image' == algorithm:
+        gnlmaps = calculate_local_std_by_label(pixels, segmap, [tissue.value for tissue in tissues], kernel_size_px)
+    else:
+        gnlmaps = []
+        for tissue in tissues:
+            tissue_mask = segmap == tissue.value
+            img_gnl = calculate_local_std(np.where(tissue_mask, pixels, 0), kernel_size_px, algorithm)
+            gnlmaps.append(np.where(tissue_mask, img_gnl, np.nan))
+    return {tissue: LocalStdHistogram(histogram_bin_width, histogram_max_value).add_values(gnlmap)
+            for tissue, gnlmap in zip(tissues, gnlmaps)}
+
+
+def _volume_gnl_job(job):
+    return calculate_slice_gnl_histograms(*job)
+
+
+def _iterate_in_pool(function, jobs, max_workers=None, use_threads=False):
+    """Like executor.map, but jobs are submitted only a few at a time so that they can be produced lazily"""
+    executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        max_pending = 2 * (max_workers or os.cpu_count() or 1)
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(function, job))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def calculate_volume_gnl(dicom_images, tissues=SegMats.SOFT_TISSUE, kernel_radius_mm=3,
+                         hu_ranges=get_default_segmentation_thresholds(), mask_rois=None,
+                         algorithm='masked_integral_image', histogram_bin_width=1.0,
+                         histogram_max_value=LOCAL_STD_MAX_VALUE, max_workers=None, use_threads=False, body_mask=False):
+    """
+    GNL of every slice of an exam, for each tissue, with slices distributed on a pool of workers.
+
+    Each slice produces a fixed-bin histogram of local SD per tissue: its mode is the GNL of the slice, and the
+    histograms of all the slices are merged to obtain the GNL of the whole exam.
+    :param dicom_images: list or iterable (e.g. a generator loading the files) of images with 'pixels' and 'header'
+    :param tissues: tissue or list of tissues, None for all the pixels without segmentation (as in calculate_gnl())
+    :param max_workers: size of the pool (None: number of processors, 1: no pool)
+    :param body_mask: restrict the calculation to the patient body (see get_body_mask())
+    :return: a dictionary with the slice positions 'z', 'gnl' = {tissue: list of per-slice GNL},
+             'gnl_exam' = {tissue: GNL of the exam} and 'histograms' = {tissue: pooled LocalStdHistogram}
+    """
+    if isinstance(dicom_images, dict):
+        dicom_images = [dicom_images]
+    if not isinstance(tissues, list):
+        tissues = [tissues]
+    z_positions = []
+
+    def jobs():
+        for i, dicom_image in enumerate(dicom_images):
+            header = dicom_image['header']
+            z_positions.append(get_slice_position(header, i))
+            yield (dicom_image['pixels'], float(header.PixelSpacing[0]), tissues, kernel_radius_mm, hu_ranges,
+                   mask_rois, algorithm, histogram_bin_width, histogram_max_value, body_mask)
+
+    if max_workers == 1:
+        slice_histograms = map(_volume_gnl_job, jobs())
+    else:
+        slice_histograms = _iterate_in_pool(_volume_gnl_job, jobs(), max_workers=max_workers, use_threads=use_threads)
+    gnls = {tissue: [] for tissue in tissues}
+    histograms = {tissue: LocalStdHistogram(histogram_bin_width, histogram_max_value) for tissue in tissues}
+    for slice_histogram in slice_histograms:
+        for tissue in tissues:
+            gnls[tissue].append(slice_histogram[tissue].mode())
+            histograms[tissue].merge(slice_histogram[tissue])
+    return {
+        'z': z_positions,
+        'gnl': gnls,
+        'gnl_exam': {tissue: histogram.mode() for tissue, histogram in histograms.items()},
+        'histograms': histograms
+    }
+
+
+def calculate_gnl_kernel_sweep(dicom_images, kernel_radii_mm, tissues=SegMats.SOFT_TISSUE,
+                               hu_ranges=get_default_segmentation_thresholds(), mask_rois=None,
+                               histogram_bin_width=1.0, histogram_max_value=LOCAL_STD_MAX_VALUE, body_mask=False):
+    """
+    GNL for several kernel radii (e.g. to study the sensitivity of GNL to the kernel size) in a single call.
+
+    Each slice is segmented once and its summed-area tables are built once, for the largest kernel: all the local SD
+    maps come from the same tables. Local SD are normalized by tissue as in calculate_local_std_by_label().
+    :return: a dictionary with 'kernel_radius_mm', 'kernel_size_px' and 'gnl' = {tissue: list of GNL, one per radius},
+             where each GNL is the mode of the histogram pooled over all the slices
+    """
+    if not isinstance(dicom_images, list):
+        dicom_images = [dicom_images]
+    if not isinstance(tissues, list):
+        tissues = [tissues]
+    kernel_radii_mm = list(kernel_radii_mm)
+    histograms = {tissue: [LocalStdHistogram(histogram_bin_width, histogram_max_value) for _ in kernel_radii_mm]
+                  for tissue in tissues}
+    kernel_sizes_px = []
+    for dicom_image in dicom_images:
+        pixels = apply_mask_rois(dicom_image['pixels'], mask_rois)
+        pixel_spacing_mm = dicom_image['header'].PixelSpacing[0]
+        kernel_sizes_px = [get_kernel_size_px(radius, pixel_spacing_mm) for radius in kernel_radii_mm]
+        window, body = get_body_window(pixels, max(kernel_sizes_px), body_mask)
+        pixels = pixels[window]
+        segmap = segment_with_lut(pixels, hu_ranges, mask=body)
+        tables = get_label_integral_images(pixels, segmap, [tissue.value for tissue in tissues],
+                                           max(kernel_sizes_px) // 2)
+        for k, kernel_size_px in enumerate(kernel_sizes_px):
+            gnlmaps = calculate_local_std_from_label_integrals(tables, kernel_size_px)
+            for tissue, gnlmap in zip(tissues, gnlmaps):
+                histograms[tissue][k].add_values(gnlmap)
+    return {
+        'kernel_radius_mm': kernel_radii_mm,
+        'kernel_size_px': [int(kernel_size_px) for kernel_size_px in kernel_sizes_px],
+        'gnl': {tissue: [histogram.mode() for histogram in histograms[tissue]] for tissue in tissues}
+    }
+
+
 def calculate_gnl(dicom_images, tissues=SegMats.SOFT_TISSUE, kernel_radius_mm=3,
                   hu_ranges=get_default_segmentation_thresholds(),
                   return_plot_data=False, mask_rois=None,
-                  algorithm='convolution'):
+                  algorithm='integral_image', body_mask=False, histogram_bin_width=1.0,
+                  histogram_max_value=LOCAL_STD_MAX_VALUE):
     # input preparation
     if not isinstance(dicom_images, list):
         dicom_images = [dicom_images]
@@ -49,27 +452,10 @@ def calculate_gnl(dicom_images, tissues=SegMats.SOFT_TISSUE, kernel_radius_mm=3,
     # calculation
     gnls = []
     for dicom_image in dicom_images:
-        pixels = dicom_image['pixels']
-        # 0. masking ROIs (e.g. image numbers, arrows...)
-        if mask_rois is not None:
-            if not isinstance(mask_rois, list):
-                mask_rois = [mask_rois]
-            for roi in mask_rois:
-                pixels[roi[0]:roi[1], roi[2]:roi[3]] = roi[4]
-        # 1. threshold-based segmentation
-        segmap = segment_with_thresholds(pixels, hu_ranges)
-        # 2. calculation of local SD - kernel has always an odd number of pixels
-        kernel_size_px = 1 + np.round(2 * kernel_radius_mm / dicom_image['header'].PixelSpacing[0]).astype(int)
-        if [None] != tissues:
-            gnlmap = np.zeros(segmap.shape)
-            for tissue in tissues:
-                img_segm = np.where(segmap == tissue.value, pixels, 0)
-                img_gnl = calculate_local_std(img_segm, kernel_size_px, algorithm)
-                gnlmap = np.where(segmap == tissue.value, img_gnl, gnlmap)
-        else:
-            gnlmap = calculate_local_std(img_segm, kernel_size_px, algorithm)
-        # 3. histogram of local SD and mode
-        gnls.append(get_histogram_mode(gnlmap))
-        if return_plot_data:
+        gnl, pixels, segmap, gnlmap = calculate_slice_gnl(dicom_image['pixels'], dicom_image['header'].PixelSpacing[0],
+                                                          tissues, kernel_radius_mm, hu_ranges, mask_rois, algorithm,
+                                                          body_mask, histogram_bin_width, histogram_max_value)
+        gnls.append(gnl)
+        if return_plot_data:  # plot data refer to the first image only
             return np.mean(gnls), np.std(gnls), pixels, segmap, gnlmap
     return np.mean(gnls), np.std(gnls)
@@ -1,5 +1,7 @@
 import numpy as np
 from actilib.helpers.math import subtract_2d_poly_mean, radial_profile, smooth, get_polar_mesh
+from actilib.analysis.rois import SquareROI, calculate_noise_map
+from actilib.analysis.segmentation import SegMats, HU_RANGES, segment_with_lut, get_body_mask
 
 
 def calculate_roi_nps2d(pixels, roi, pixel_size_xy_mm, fft_samples=128):
@@ -10,9 +12,69 @@ def calculate_roi_nps2d(pixels, roi, pixel_size_xy_mm, fft_samples=128):
     return nps, np.mean(roi_image)
 
 
+def find_uniform_rois(pixels, roi_size_px, num_rois=1, tissue=SegMats.SOFT_TISSUE, hu_ranges=HU_RANGES,
+                      step_px=None, body_mask=True):
+    """
+    Search the most uniform square ROIs of a slice (e.g. for the NPS of patient images): the ROIs must lie entirely in
+    the tissue and are ranked by their standard deviation after subtracting the polynomial mean, as in the NPS.
+
+    :param roi_size_px: ROI side, or a list of sides: the largest one for which ROIs are found is used
+    :param step_px: spacing of the candidate ROIs (default: a quarter of the ROI side)
+    :param body_mask: search only inside the patient body (see get_body_mask())
+    :return: list of at most num_rois non-overlapping SquareROI, from the least noisy
+    """
+    pixels = np.asarray(pixels)
+    segmap = segment_with_lut(pixels, hu_ranges, mask=get_body_mask(pixels) if body_mask else None)
+    tissue_mask = (segmap == tissue.value).astype(np.float64)
+    for size in sorted(np.atleast_1d(roi_size_px), reverse=True):
+        size = int(size)
+        if size > min(pixels.shape):
+            continue
+        step = step_px if step_px is not None else max(size // 4, 1)
+        tissue_fraction = calculate_noise_map(tissue_mask, size, step)['mean']
+        noise_map = calculate_noise_map(pixels, size, step, detrend=True)
+        candidates = np.flatnonzero(tissue_fraction.ravel() > 1 - 1e-6)
+        candidates = candidates[np.argsort(noise_map['std'].ravel()[candidates], kind='stable')]
+        centers_y = noise_map['centers_y'][candidates // tissue_fraction.shape[1]]
+        centers_x = noise_map['centers_x'][candidates % tissue_fraction.shape[1]]
+        selected = []
+        for center_x, center_y in zip(centers_x, centers_y):
+            if len(selected) == num_rois:
+                break
+            if all(abs(center_x - roi.center_x()) >= size or abs(center_y - roi.center_y()) >= size
+                   for roi in selected):
+                selected.append(SquareROI(size, float(center_x), float(center_y)))
+        if selected:
+            return selected
+    return []
+
+
+def find_nps_rois(dicom_images, roi_size_px=64, tissue=SegMats.SOFT_TISSUE, hu_ranges=HU_RANGES, step_px=None,
+                  body_mask=True):
+    """The most uniform ROI of each image (None where none is found), to be used in noise_properties()"""
+    if not isinstance(dicom_images, list):
+        dicom_images = [dicom_images]
+    rois = []
+    for image in dicom_images:
+        found = find_uniform_rois(image['pixels'], roi_size_px, 1, tissue, hu_ranges, step_px, body_mask)
+        rois.append(found[0] if found else None)
+    return rois
+
+
 def noise_properties(dicom_images, roi, fft_samples=128):
+    """
+    NPS and noise properties of a series of images, in a ROI common to all the images or in one ROI per image (a list,
+    e.g. from find_nps_rois(); images with a None ROI are skipped)
+    """
     if not isinstance(dicom_images, list):
         dicom_images = [dicom_images]
+    rois = roi if isinstance(roi, list) else [roi] * len(dicom_images)
+    if len(rois) != len(dicom_images):
+        raise ValueError('{} ROIs for {} images: one ROI per image is needed'.format(len(rois), len(dicom_images)))
+    dicom_images = [image for image, image_roi in zip(dicom_images, rois) if image_roi is not None]
+    rois = [image_roi for image_roi in rois if image_roi is not None]
+    if len(dicom_images) == 0:
+        raise ValueError('no images with a ROI for the NPS')
     pixel_size_xy_mm = np.array(dicom_images[0]['header'].PixelSpacing)
     pixel_size_x_mm, pixel_size_y_mm = pixel_size_xy_mm
     images = []
@@ -27,8 +89,8 @@ def noise_properties(dicom_images, roi, fft_samples=128):
     hu_series = []
     nps_series = []
     var_series = []
-    for image in images:
-        nps, hu = calculate_roi_nps2d(image, roi, pixel_size_xy_mm, fft_samples=fft_samples)
+    for image, image_roi in zip(images, rois):
+        nps, hu = calculate_roi_nps2d(image, image_roi, pixel_size_xy_mm, fft_samples=fft_samples)
         hu_series.append(hu)
         nps_series.append(nps)
         var_series.append(np.sum(nps) * dfreq_x * dfreq_y)
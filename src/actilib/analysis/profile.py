@@ -0,0 +1,102 @@
+import math
+import numpy as np
+from actilib.analysis.segmentation import get_body_mask
+
+"""
+Longitudinal profiles of a CT series: tube current (or CTDIvol), water equivalent diameter and scout-like image.
+The output follows the 'values_profile' structure of resources/matlab/save_json_results.m (imQuest).
+"""
+
+CTDIVOL_LIMITS = [0, 2, 10, 50, 100]
+EFFECTIVE_MAS_LIMITS = [0, 50, 100, 800, 1000, 2000]
+
+
+def get_effective_mas(dicom_header):
+    """Effective mAs of a slice: tube current times rotation time, divided by the pitch"""
+    current_ma = float(dicom_header.XRayTubeCurrent)
+    if getattr(dicom_header, 'RevolutionTime', None) is not None:
+        time_s = float(dicom_header.RevolutionTime)
+    else:
+        time_s = float(dicom_header.ExposureTime) / 1000
+    if getattr(dicom_header, 'SpiralPitchFactor', None) is not None:
+        pitch = float(dicom_header.SpiralPitchFactor)
+    elif getattr(dicom_header, 'TableFeedPerRotation', None) is not None \
+            and getattr(dicom_header, 'TotalCollimationWidth', None) is not None:
+        pitch = float(dicom_header.TableFeedPerRotation) / float(dicom_header.TotalCollimationWidth)
+    else:
+        pitch = 1
+    return current_ma * time_s / pitch
+
+
+def get_profile_limits(values, limits):
+    """Y range of the profile plot: the first of the nominal limits above the maximum, or 10% above the maximum"""
+    max_value = max(values)
+    index = int(np.searchsorted(limits, max_value, side='right'))
+    if index >= len(limits):
+        return [limits[0], max_value * 1.1]
+    return [limits[0], limits[index]]
+
+
+def get_header_values(dicom_headers, keyword):
+    """Values of a numeric DICOM attribute, one per header (None where missing)"""
+    values = [getattr(header, keyword, None) for header in dicom_headers]
+    return [float(value) if value is not None and value != '' else None for value in values]
+
+
+def get_exposure_values(dicom_headers):
+    """Tube current [mA] and CTDIvol [mGy] of each slice (None where missing), from the headers only"""
+    return {'current_ma': get_header_values(dicom_headers, 'XRayTubeCurrent'),
+            'ctdivol': get_header_values(dicom_headers, 'CTDIvol')}
+
+
+def get_tube_current_profile(dicom_headers):
+    """
+    CTDIvol of each slice if available in the headers, otherwise the effective mAs, with label and plot limits.
+    Only the headers are needed, e.g. from load_headers_from_directory().
+    """
+    ctdivol = get_header_values(dicom_headers, 'CTDIvol')
+    if None not in ctdivol:
+        values, label, limits = ctdivol, 'CTDI_{vol} [mGy]', CTDIVOL_LIMITS
+    else:
+        values = [get_effective_mas(header) for header in dicom_headers]
+        label, limits = 'Effective mAs', EFFECTIVE_MAS_LIMITS
+    return {'values': values, 'label': label, 'limits': get_profile_limits(values, limits)}
+
+
+def calculate_wed(pixels, pixel_size_xy_mm):
+    """
+    Water equivalent diameter [mm] (AAPM report 220): diameter of the water disk with the same attenuation of the
+    patient body, as found by get_body_mask().
+    :param pixels: a slice (y, x) or a volume (z, y, x)
+    :return: the WED of the slice, or an array with the WED of each slice of the volume
+    """
+    pixels = np.asarray(pixels)
+    body = get_body_mask(pixels)
+    water_area_mm2 = np.sum(np.where(body, pixels / 1000 + 1, 0), axis=(-2, -1)) \
+        * pixel_size_xy_mm[0] * pixel_size_xy_mm[1]
+    wed = 2 * np.sqrt(np.clip(water_area_mm2, 0, None) / math.pi)
+    return float(wed) if pixels.ndim == 2 else wed
+
+
+def calculate_scout_image(volume):
+    """
+    Scout-like image (y, z) of a volume (z, y, x): 2/3 of the mean plus 1/3 of the maximum projection along x, each one
+    scaled to [0, 1], as integers in [0, 1000]
+    """
+    def scaled(image):
+        value_range = np.max(image) - np.min(image)
+        return (image - np.min(image)) / value_range if value_range > 0 else np.zeros(image.shape)
+    volume = np.asarray(volume)
+    scout = 2 / 3 * scaled(np.mean(volume, axis=2)) + 1 / 3 * scaled(np.max(volume, axis=2))
+    return np.round(scout.T * 1000).astype(int)
+
+
+def get_values_profile(dicom_images):
+    """The 'values_profile' structure: scout image, tube current profile and WED of each slice"""
+    pixel_size_xy_mm = np.array(dicom_images[0]['header'].PixelSpacing, dtype=float)
+    volume = np.stack([image['pixels'] for image in dicom_images])
+    return {
+        'scout_image': calculate_scout_image(volume).tolist(),
+        'profile': get_tube_current_profile([image['header'] for image in dicom_images]),
+        'wed': calculate_wed(volume, pixel_size_xy_mm).tolist()
+    }
@@ -1,32 +1,59 @@
-import copy
 import math
 import numpy as np
 import numpy.ma as ma
-from actilib.helpers.math import rad_from_deg
+from functools import lru_cache
+from scipy.special import comb
+from actilib.helpers.math import rad_from_deg, get_integral_image
+
+
+ROI_MASK_CACHE_SIZE = 256  # number of bounding-box masks kept in memory, shared by all the ROIs
+
+
+@lru_cache(maxsize=ROI_MASK_CACHE_SIZE)
+def get_square_bbox_mask(height, width, inner_tblr=None):
+    """Read-only boolean mask of a square ROI over its bounding box, with the inner box [t, b, l, r] excluded"""
+    mask = np.ones((height, width), dtype=bool)
+    if inner_tblr is not None:
+        mask[max(0, inner_tblr[0]):max(0, inner_tblr[1]), max(0, inner_tblr[2]):max(0, inner_tblr[3])] = False
+    mask.flags.writeable = False
+    return mask
+
+
+@lru_cache(maxsize=ROI_MASK_CACHE_SIZE)
+def get_circle_bbox_mask(height, width, offset_y, offset_x, radius_inner, radius_outer):
+    """Read-only boolean mask of an annulus over its bounding box; the offsets locate the center in the box"""
+    grid_y, grid_x = np.ogrid[:height, :width]
+    dist_from_center = np.sqrt((grid_x - offset_x) ** 2 + (grid_y - offset_y) ** 2)
+    mask = (dist_from_center <= radius_outer) & (dist_from_center >= radius_inner)
+    mask.flags.writeable = False
+    return mask
 
 
 class PixelROI:
     """
     Represent a generic ROI. Values represent pixels, this affects rounding.
+    ROIs have no per-instance dictionary (__slots__), so that many of them can be created and copied cheaply.
     """
+    __slots__ = ('_size', '_center_x', '_center_y', '_flag_center_adjusted', '_name')
+
     def __init__(self, size, center_x, center_y, name=None):
         self._size = size
         self._center_x = center_x
         self._center_y = center_y
         self._flag_center_adjusted = False
-        self._name = name if name is not None else 'ROI-{}'.format(id(self))
+        self._name = name
 
     def as_dict(self):
         return {
-            'Name': self._name, 'Shape': self.shape(),
+            'Name': self.name(), 'Shape': self.shape(),
             'Center X': self._center_x, 'Center Y': self._center_y, 'Size': self._size
         }
 
     def name(self):
-        return self._name
+        return self._name if self._name is not None else 'ROI-{}'.format(id(self))  # default name only when asked
 
     def shape(self):
-        raise None
+        raise NotImplementedError
 
     def size(self):
         return self._size
@@ -34,6 +61,26 @@ class PixelROI:
     def set_size(self, size):
         self._size = size
 
+    def copy(self, size=None, center_x=None, center_y=None):
+        """Copy of the ROI (with the same name), optionally with a different size or center"""
+        roi = object.__new__(type(self))
+        roi._size = self._size if size is None else size
+        roi._center_x = self._center_x if center_x is None else center_x
+        roi._center_y = self._center_y if center_y is None else center_y
+        roi._flag_center_adjusted = self._flag_center_adjusted and center_x is None and center_y is None
+        roi._name = self._name
+        return roi
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def resized(self, margin):
+        """Copy of the ROI enlarged by margin pixels on each side (shrunk if negative)"""
+        return self.copy(size=self._size + 2 * margin)
+
     def width(self, margin=0.0):
         return int(self._size + 2 * margin + 0.5)
 
@@ -69,29 +116,88 @@ class PixelROI:
         return self.get_annular_mask(image)
 
     def get_annular_mask(self, image=None, radius_inner=0.0, radius_outer=None):
-        raise NotImplemented
+        if image is None:
+            raise NotImplementedError
+        [i_t, i_b, i_l, i_r], mask = self.get_clipped_bbox_mask(image.shape, radius_inner, radius_outer)
+        full_mask = np.zeros(image.shape[-2:], dtype=int)
+        full_mask[i_t:i_b, i_l:i_r] = mask
+        return full_mask
+
+    def get_bbox_mask(self, radius_inner=0.0, radius_outer=None):
+        """
+        Boolean annular mask over the bounding box of the ROI, and the position [t, b, l, r] of the box in the image.
+        Masks are cached and read-only: they are shared by all the ROIs with the same shape and sub-pixel position.
+        """
+        raise NotImplementedError
+
+    def get_clipped_bbox_mask(self, image_shape, radius_inner=0.0, radius_outer=None):
+        """Like get_bbox_mask(), with the box clipped to the image limits (possibly an empty box)"""
+        [i_t, i_b, i_l, i_r], mask = self.get_bbox_mask(radius_inner, radius_outer)
+        size_y, size_x = image_shape[-2:]
+        c_t, c_b = min(max(i_t, 0), size_y), min(max(i_b, 0), size_y)
+        c_l, c_r = min(max(i_l, 0), size_x), min(max(i_r, 0), size_x)
+        c_b, c_r = max(c_b, c_t), max(c_r, c_l)
+        return [c_t, c_b, c_l, c_r], mask[c_t - i_t:c_b - i_t, c_l - i_l:c_r - i_l]
+
+    def get_crop_and_mask(self, image, radius_inner=0.0, radius_outer=None):
+        """View of the image over the ROI bounding box and the corresponding boolean annular mask"""
+        [i_t, i_b, i_l, i_r], mask = self.get_clipped_bbox_mask(image.shape, radius_inner, radius_outer)
+        return image[..., i_t:i_b, i_l:i_r], mask
 
     def get_masked_image(self, image):
-        return np.multiply(image, self.get_mask(image))
+        [i_t, i_b, i_l, i_r], mask = self.get_clipped_bbox_mask(image.shape)
+        masked = np.zeros(image.shape, dtype=np.result_type(image, int))
+        masked[..., i_t:i_b, i_l:i_r] = np.where(mask, image[..., i_t:i_b, i_l:i_r], 0)
+        return masked
+
+    def get_roi_mask(self):
+        """Boolean mask of the ROI over its own crop, as get_mask() without image, cached and read-only"""
+        raise NotImplementedError
 
     def get_cropped_image(self, image):
+        """
+        Masked array of the image over the ROI: the pixels outside the ROI shape are masked (and set to 0).
+        The image is cropped first, so that a square ROI returns a view of the image. With a stack of images (3D) the
+        crops of all the slices come as one array, with the same mask.
+        """
         [y1, y2, x1, x2] = self.indexes_tblr()
-        masked = self.get_masked_image(image)[y1:y2, x1:x2]
-        return np.ma.masked_where(1 - self.get_mask(), masked)
-
-    def get_area(self):
-        return np.sum(self.get_mask())
+        crop = image[..., y1:y2, x1:x2]
+        window_mask = self.get_window_mask([y1, y2, x1, x2])
+        if not window_mask.all():
+            crop = np.where(window_mask, crop, 0)
+        return np.ma.masked_array(crop, mask=np.broadcast_to(~self.get_roi_mask(), crop.shape))
+
+    def get_window_mask(self, window_tblr, radius_inner=0.0, radius_outer=None):
+        """Boolean annular mask of the ROI (at its position in the image) over the window [t, b, l, r] of the image"""
+        [i_t, i_b, i_l, i_r], mask = self.get_bbox_mask(radius_inner, radius_outer)
+        [w_t, w_b, w_l, w_r] = window_tblr
+        window_mask = np.zeros((w_b - w_t, w_r - w_l), dtype=bool)
+        o_t, o_b, o_l, o_r = max(i_t, w_t), min(i_b, w_b), max(i_l, w_l), min(i_r, w_r)
+        if o_t < o_b and o_l < o_r:
+            window_mask[o_t - w_t:o_b - w_t, o_l - w_l:o_r - w_l] = mask[o_t - i_t:o_b - i_t, o_l - i_l:o_r - i_l]
+        return window_mask
+
+    def get_area(self, image=None):
+        """Number of pixels of the ROI, only those inside the image if one is given"""
+        if image is None:
+            return np.sum(self.get_mask())
+        return np.count_nonzero(self.get_clipped_bbox_mask(image.shape)[1])
 
     def get_masked_sum(self, image):
-        return np.sum(np.multiply(image, self.get_mask(image)))
+        crop, mask = self.get_crop_and_mask(image)
+        return np.sum(crop[..., mask])
+
+    def get_masked_mean(self, image):
+        crop, mask = self.get_crop_and_mask(image)
+        return np.mean(crop[..., mask])
 
     def auto_adjust_center(self, image, max_correction_px=5, force_recalculation=False):
         if self._flag_center_adjusted and not force_recalculation:
             return self.center_x(), self.center_y()
         # get the average value inside the ROI
-        fgd_mask = self.get_annular_mask(image, radius_outer=0.4*self.size())
-        fgd_mean = np.mean(image[fgd_mask == 1])
-        fgd_std = np.std(image[fgd_mask == 1])
+        fgd_crop, fgd_mask = self.get_crop_and_mask(image, radius_outer=0.4*self.size())
+        fgd_mean = np.mean(fgd_crop[fgd_mask])
+        fgd_std = np.std(fgd_crop[fgd_mask])
         # crop the image and mask according to value interval
         [i_t, i_b, i_l, i_r] = self.indexes_tblr(margin_px=5+max_correction_px)  # arbitrary margin so that the crop contains the gradient
         crop = image[i_t:i_b, i_l:i_r]
@@ -123,6 +229,8 @@ class PixelROI:
 
 
 class SquareROI(PixelROI):
+    __slots__ = ()
+
     def __init__(self, side, center_x=None, center_y=None, name=None):
         super().__init__(side,
                          center_x if center_x is not None else side / 2.0,
@@ -144,18 +252,30 @@ class SquareROI(PixelROI):
         """
         if image is None:
             return np.ones((self.height(), self.width()))
+        return super().get_annular_mask(image, radius_inner, radius_outer)
+
+    def get_roi_mask(self):
+        return get_square_bbox_mask(self.height(), self.width())
+
+    def get_bbox_mask(self, radius_inner=0.0, radius_outer=None):
         if radius_outer is None:
             radius_outer = self.size() / 2.0
-        mask = np.zeros(image.shape)
-        if radius_inner <= radius_outer:
-            mask[max(0, int(self._center_y - radius_outer + 0.5)):min(mask.shape[0], int(self._center_y + radius_outer + 0.5)),
-                 max(0, int(self._center_x - radius_outer + 0.5)):min(mask.shape[1], int(self._center_x + radius_outer + 0.5))] = 1
-            mask[max(0, int(self._center_y - radius_inner + 0.5)):min(mask.shape[0], int(self._center_y + radius_inner + 0.5)),
-                 max(0, int(self._center_x - radius_inner + 0.5)):min(mask.shape[1], int(self._center_x + radius_inner + 0.5))] = 1
-        return mask.astype(int)
+        outer_tblr = [math.floor(c + sign * radius_outer + 0.5) for c, sign in
+                      [(self._center_y, -1), (self._center_y, 1), (self._center_x, -1), (self._center_x, 1)]]
+        height, width = max(outer_tblr[1] - outer_tblr[0], 0), max(outer_tblr[3] - outer_tblr[2], 0)
+        if radius_inner > radius_outer:
+            return outer_tblr, np.zeros((height, width), dtype=bool)
+        inner_tblr = None
+        if radius_inner > 0:
+            inner_tblr = tuple(math.floor(c + sign * radius_inner + 0.5) - origin for c, sign, origin in
+                               [(self._center_y, -1, outer_tblr[0]), (self._center_y, 1, outer_tblr[0]),
+                                (self._center_x, -1, outer_tblr[2]), (self._center_x, 1, outer_tblr[2])])
+        return outer_tblr, get_square_bbox_mask(height, width, inner_tblr)
 
 
 class CircleROI(PixelROI):
+    __slots__ = ()
+
     def __init__(self, radius, center_x=None, center_y=None, name=None):
         super().__init__(2 * radius,
                          center_x if center_x is not None else radius,
@@ -175,17 +295,35 @@ class CircleROI(PixelROI):
         The position of the ROI is defined by "center" attributes and it assumes a common pixel coordinate system with
          0,0 at the top left of the image. The ROI can be totally or partially outside of the image.
         """
+        if image is not None:
+            return super().get_annular_mask(image, radius_inner, radius_outer)
         if radius_outer is None:
             radius_outer = self.size() / 2.0
-        mask_size_x = int(2 * radius_outer + 0.5) if image is None else image.shape[1]
-        mask_size_y = int(2 * radius_outer + 0.5) if image is None else image.shape[0]
-        mask = np.zeros((mask_size_y, mask_size_x))
+        mask_size = int(2 * radius_outer + 0.5)
+        mask = np.zeros((mask_size, mask_size))
         if radius_inner <= radius_outer:
-            dist_from_center = self.get_distance_from_center(image, (mask_size_y, mask_size_x))
+            dist_from_center = self.get_distance_from_center(None, (mask_size, mask_size))
             mask[dist_from_center <= radius_outer] = 1
             mask[dist_from_center < radius_inner] = 0
         return mask.astype(int)
 
+    def get_roi_mask(self):
+        mask_size = int(self.size() + 0.5)
+        return get_circle_bbox_mask(mask_size, mask_size, self.size() / 2 - 0.5, self.size() / 2 - 0.5, 0.0,
+                                    self.size() / 2.0)
+
+    def get_bbox_mask(self, radius_inner=0.0, radius_outer=None):
+        if radius_outer is None:
+            radius_outer = self.size() / 2.0
+        i_t, i_b = math.ceil(self._center_y - radius_outer), math.floor(self._center_y + radius_outer) + 1
+        i_l, i_r = math.ceil(self._center_x - radius_outer), math.floor(self._center_x + radius_outer) + 1
+        if i_b <= i_t or i_r <= i_l:
+            return [i_t, i_t, i_l, i_l], np.zeros((0, 0), dtype=bool)
+        if radius_inner > radius_outer:
+            return [i_t, i_b, i_l, i_r], np.zeros((i_b - i_t, i_r - i_l), dtype=bool)
+        return [i_t, i_b, i_l, i_r], get_circle_bbox_mask(i_b - i_t, i_r - i_l, self._center_y - i_t,
+                                                          self._center_x - i_l, radius_inner, radius_outer)
+
 
 def create_circle_of_rois(num_rois, roi_size_px, distance_from_center_px,
                           circle_center_x_px=0, circle_center_y_px=0, angle_offset_deg=0, roi_shape='square'):
@@ -202,46 +340,253 @@ def create_circle_of_rois(num_rois, roi_size_px, distance_from_center_px,
                           circle_center_y_px + distance_from_center_px * math.sin(angle)) for angle in angles_rad]
 
 
+class RoiSet:
+    """
+    Many square and circular ROIs stored as arrays (centers, sizes and shapes), for statistics on all of them at once.
+
+    ROIs with the same bounding box size are processed together: their crops are gathered in one array (pixels outside
+    the image are excluded) and the statistics are reduced over the masked crops. ROIs can overlap, and the results are
+    the same as those of the individual SquareROI/CircleROI objects.
+    """
+
+    def __init__(self, sizes, centers_x, centers_y, shapes='square', names=None):
+        self.sizes = np.asarray(sizes, dtype=float).ravel()
+        self.centers_x = np.broadcast_to(np.asarray(centers_x, dtype=float), self.sizes.shape).copy()
+        self.centers_y = np.broadcast_to(np.asarray(centers_y, dtype=float), self.sizes.shape).copy()
+        self.shapes = np.broadcast_to(np.asarray(shapes), self.sizes.shape).copy()
+        self.names = names
+
+    @classmethod
+    def from_rois(cls, rois):
+        names = [roi._name for roi in rois]  # unnamed ROIs stay unnamed
+        return cls([roi.size() for roi in rois], [roi.center_x() for roi in rois], [roi.center_y() for roi in rois],
+                   [roi.shape() for roi in rois], names if any(name is not None for name in names) else None)
+
+    def to_rois(self):
+        names = self.names if self.names is not None else [None] * len(self)
+        return [create_roi(shape, size, center_x, center_y, name) for shape, size, center_x, center_y, name in
+                zip(self.shapes.tolist(), self.sizes.tolist(), self.centers_x.tolist(), self.centers_y.tolist(), names)]
+
+    @classmethod
+    def from_dicts(cls, roi_dicts):
+        """ROI set from a list of dictionaries as those of PixelROI.as_dict() (e.g. loaded from JSON)"""
+        columns = {key: [roi_dict[key] for roi_dict in roi_dicts] for key in ['Size', 'Center X', 'Center Y', 'Name']}
+        return cls(columns['Size'], columns['Center X'], columns['Center Y'],
+                   [str(roi_dict['Shape']).lower() for roi_dict in roi_dicts], columns['Name'])
+
+    def as_dicts(self):
+        """List of dictionaries as those of PixelROI.as_dict(), with native types (ready for JSON)"""
+        names = self.names if self.names is not None else ['ROI-{}'.format(i) for i in range(len(self))]
+        return [{'Name': name, 'Shape': shape, 'Center X': center_x, 'Center Y': center_y, 'Size': size}
+                for name, shape, center_x, center_y, size in
+                zip(names, self.shapes.tolist(), self.centers_x.tolist(), self.centers_y.tolist(), self.sizes.tolist())]
+
+    def __len__(self):
+        return self.sizes.size
+
+    def get_bboxes(self):
+        """Bounding boxes of the ROIs as an (n, 4) integer array of [t, b, l, r], as in PixelROI.get_bbox_mask()"""
+        radii = self.sizes / 2.0
+        circles = self.shapes == 'circle'
+        bboxes = np.empty((len(self), 4), dtype=np.int64)
+        for k, centers in enumerate([self.centers_y, self.centers_x]):
+            bboxes[:, 2 * k] = np.where(circles, np.ceil(centers - radii), np.floor(centers - radii + 0.5))
+            bboxes[:, 2 * k + 1] = np.where(circles, np.floor(centers + radii) + 1, np.floor(centers + radii + 0.5))
+        bboxes[:, 1::2] = np.maximum(bboxes[:, 1::2], bboxes[:, 0::2])
+        return bboxes
+
+    def get_statistics(self, image):
+        """
+        Mean, standard deviation, minimum and maximum of the pixels of each ROI, and its area (pixels in the image).
+
+        :param image: a 2D image or a stack of images (3D), in which case the statistics are calculated per slice
+        :return: a dictionary of arrays, in the order of the ROIs, with shape (n,) or (slices, n); 'area' is always (n,)
+                 and ROIs without pixels in the image get NaN statistics
+        """
+        image = np.asarray(image)
+        size_y, size_x = image.shape[-2:]
+        bboxes = self.get_bboxes()
+        heights, widths = bboxes[:, 1] - bboxes[:, 0], bboxes[:, 3] - bboxes[:, 2]
+        circles = self.shapes == 'circle'
+        stats = {name: np.full(image.shape[:-2] + (len(self),), np.nan) for name in ['mean', 'std', 'min', 'max']}
+        stats['area'] = np.zeros(len(self), dtype=np.int64)
+        groups = np.stack([circles, heights, widths], axis=1)
+        for is_circle, height, width in np.unique(groups, axis=0):
+            indexes = np.flatnonzero(np.all(groups == [is_circle, height, width], axis=1))
+            if height == 0 or width == 0:
+                continue  # empty ROIs
+            grid_y = bboxes[indexes, 0][:, None] + np.arange(height)  # (n, height)
+            grid_x = bboxes[indexes, 2][:, None] + np.arange(width)  # (n, width)
+            mask = ((0 <= grid_y) & (grid_y < size_y))[:, :, None] & ((0 <= grid_x) & (grid_x < size_x))[:, None, :]
+            if is_circle:
+                offsets_y = (self.centers_y[indexes] - bboxes[indexes, 0])[:, None, None]
+                offsets_x = (self.centers_x[indexes] - bboxes[indexes, 2])[:, None, None]
+                dist_from_center = np.sqrt((np.arange(width)[None, None, :] - offsets_x) ** 2 +
+                                           (np.arange(height)[None, :, None] - offsets_y) ** 2)
+                mask &= dist_from_center <= self.sizes[indexes][:, None, None] / 2.0
+            values = image[..., np.clip(grid_y, 0, size_y - 1)[:, :, None], np.clip(grid_x, 0, size_x - 1)[:, None, :]]
+            area = np.count_nonzero(mask, axis=(-2, -1))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.sum(np.where(mask, values, 0), axis=(-2, -1)) / area
+                variance = np.sum(np.where(mask, (values - mean[..., None, None]) ** 2, 0), axis=(-2, -1)) / area
+            stats['mean'][..., indexes] = mean
+            stats['std'][..., indexes] = np.sqrt(variance)
+            stats['min'][..., indexes] = np.where(area > 0, np.min(np.where(mask, values, np.inf), axis=(-2, -1)),
+                                                  np.nan)
+            stats['max'][..., indexes] = np.where(area > 0, np.max(np.where(mask, values, -np.inf), axis=(-2, -1)),
+                                                  np.nan)
+            stats['area'][indexes] = area
+        return stats
+
+
 def get_masked_image(pixels, mask):
     return ma.masked_array(pixels, mask=1-mask)
 
 
-def get_surrounding_sum(image, roi_small, margin=None):
+def get_roi_sum_and_area(image, roi, radius_outer=None, sat=None):
+    """
+    Sum and number of the pixels of a ROI inside the image, optionally with a different radius (half size).
+
+    Square ROIs are summed with four lookups if the summed-area table of the image is given (see get_integral_image(),
+    the same table serves all the ROIs of a slice); other ROIs use their cached mask on the crop.
+    """
+    if sat is not None and roi.shape() == 'square':
+        [i_t, i_b, i_l, i_r], mask = roi.get_clipped_bbox_mask(image.shape, radius_outer=radius_outer)
+        return sat[..., i_b, i_r] - sat[..., i_t, i_r] - sat[..., i_b, i_l] + sat[..., i_t, i_l], mask.size
+    crop, mask = roi.get_crop_and_mask(image, radius_outer=radius_outer)
+    return np.sum(crop[..., mask], axis=-1), np.count_nonzero(mask)
+
+
+def get_surrounding_sum(image, roi_small, margin=None, sat=None):
     margin = roi_small.size() / 2.0 if margin is None else margin
-    # build a second ROI
-    roi_large = copy.deepcopy(roi_small)
-    roi_large.set_size(roi_small.size() + 2 * margin)
-    sum_small = roi_small.get_masked_sum(image)
-    sum_large = roi_large.get_masked_sum(image)
+    sum_small, _ = get_roi_sum_and_area(image, roi_small, sat=sat)
+    sum_large, _ = get_roi_sum_and_area(image, roi_small, roi_small.size() / 2.0 + margin, sat)
     return sum_large - sum_small
 
 
-def get_surrounding_average(image, roi, margin_outer, margin_inner=0):
-    # build a second ROI
-    roi_small = roi
-    if margin_inner > 0:
-        roi_small = copy.deepcopy(roi)
-        roi_small.set_size(roi.size() + 2 * margin_inner)
-    roi_large = copy.deepcopy(roi)
-    roi_large.set_size(roi.size() + 2 * margin_outer)
-    area_small = np.sum(roi_small.get_mask(image))
-    area_large = np.sum(roi_large.get_mask(image))
+def get_surrounding_average(image, roi, margin_outer, margin_inner=0, sat=None):
+    """
+    Average of the ring (or frame) between margin_inner and margin_outer around the ROI.
+    The summed-area table of the image (see get_integral_image()) can be shared by many calls on the same image.
+    """
+    sum_small, area_small = get_roi_sum_and_area(image, roi, roi.size() / 2.0 + max(margin_inner, 0), sat)
+    sum_large, area_large = get_roi_sum_and_area(image, roi, roi.size() / 2.0 + margin_outer, sat)
     if area_large == area_small:  # both ROIs bigger or equal to image
         return 0.0
-    sum_small = roi_small.get_masked_sum(image)
-    sum_large = roi_large.get_masked_sum(image)
     return (sum_large - sum_small) / (area_large - area_small)
 
 
+def get_surrounding_averages(image, rois, margin_outer, margin_inner=0):
+    """Background around many ROIs of the same image, with one summed-area table for all of them"""
+    sat = get_integral_image(image) if any(roi.shape() == 'square' for roi in rois) else None
+    return [get_surrounding_average(image, roi, margin_outer, margin_inner, sat) for roi in rois]
+
+
+def get_detrending_matrices(roi_size):
+    """
+    Least-squares fit of subtract_2d_poly_mean() for square ROIs of roi_size pixels, in terms of the moments of the ROI
+    pixels with the polynomial basis x^i * y^j (i, j <= 2, i + j <= 3, as in polyfit2d(); basis k = 3 * j + i).
+
+    :return: the basis (pixels, 9), the matrix giving the coefficients from the moments and the matrix selecting the
+             coefficients used in the subtraction (coefficients -> basis weights)
+    """
+    x = np.linspace(-roi_size / 2, roi_size / 2, roi_size)
+    x, y = np.meshgrid(x, x)
+    basis = np.stack([x ** i * y ** j if i + j <= 3 else np.zeros_like(x)
+                      for j, i in np.ndindex((3, 3))], axis=-1).reshape(-1, 9)
+    fit = np.linalg.pinv(basis.T @ basis)
+    selection = np.zeros((9, 9))
+    for k_basis, k_coef in [(0, 0), (1, 1), (2, 2), (3, 3), (4, 5), (6, 6)]:  # x*y is subtracted with c[5]
+        selection[k_basis, k_coef] = 1
+    return basis, fit, selection
+
+
+def get_grid_sums(sat, roi_size, tops, lefts):
+    """Sums of the square ROIs of roi_size pixels at the given top-left corners, from a table of get_integral_image()"""
+    bottoms, rights = tops[:, None] + roi_size, lefts[None, :] + roi_size
+    return sat[..., bottoms, rights] - sat[..., tops[:, None], rights] - sat[..., bottoms, lefts[None, :]] + \
+        sat[..., tops[:, None], lefts[None, :]]
+
+
+def get_window_polynomial_moments(image, roi_size, tops, lefts):
+    """
+    Moments (..., len(tops), len(lefts), 9) of the ROIs of roi_size pixels at the given corners, see above.
+
+    The moments in the coordinates of each ROI are combined (binomial expansion) from the ROI sums of x^p * y^q * image
+    in the coordinates of the whole image, each one read from a summed-area table: cost and memory do not depend on
+    the ROI size. Image coordinates are centered, to limit the magnitude of the sums.
+    """
+    size_y, size_x = image.shape[-2:]
+    scale = roi_size / (roi_size - 1) if roi_size > 1 else 0  # pixel spacing of the ROI coordinates (see linspace)
+    x = scale * (np.arange(size_x) - (size_x - 1) / 2)
+    y = scale * (np.arange(size_y) - (size_y - 1) / 2)
+    # ROI coordinates: x_roi = x - shift_x, with x_roi = -roi_size / 2 on the first column of the ROI
+    shifts_x = scale * (lefts - (size_x - 1) / 2) + roi_size / 2
+    shifts_y = scale * (tops - (size_y - 1) / 2) + roi_size / 2
+    sums = {(p, q): get_grid_sums(get_integral_image(image * (y[:, None] ** q * x[None, :] ** p)), roi_size, tops,
+                                  lefts) for q, p in np.ndindex((3, 3)) if p + q <= 3}
+    moments = np.zeros(image.shape[:-2] + (len(tops), len(lefts), 9))
+    for j, i in np.ndindex((3, 3)):
+        if i + j > 3:
+            continue
+        for q, p in np.ndindex((j + 1, i + 1)):
+            coefficient = comb(i, p, exact=True) * comb(j, q, exact=True) \
+                * np.outer((-shifts_y) ** (j - q), (-shifts_x) ** (i - p))
+            moments[..., 3 * j + i] += coefficient * sums[(p, q)]
+    return moments
+
+
+def calculate_noise_map(image, roi_size, step=1, detrend=False):
+    """
+    Mean and standard deviation of a dense grid of (overlapping) square ROIs, e.g. for uniformity and noise maps.
+
+    The ROIs are roi_size x roi_size pixels, fully inside the image, with their top-left corners spaced by step pixels.
+    Sums come from summed-area tables, so that the cost does not depend on the ROI size. With detrend the standard
+    deviation is calculated after subtracting from each ROI the polynomial of subtract_2d_poly_mean(), as for the NPS.
+    :param image: a 2D image or a stack of images (3D), giving one map per slice
+    :return: a dictionary with the 'mean' and 'std' maps (shape (..., ny, nx)) and the ROI centers 'centers_x' (nx)
+             and 'centers_y' (ny) in pixels, as for SquareROI
+    """
+    image = np.asarray(image, dtype=np.float64)
+    size_y, size_x = image.shape[-2:]
+    if roi_size > min(size_y, size_x):
+        raise ValueError('ROI size ({}) larger than the image ({}x{})'.format(roi_size, size_y, size_x))
+    tops = np.arange(0, size_y - roi_size + 1, step)
+    lefts = np.arange(0, size_x - roi_size + 1, step)
+    offset = np.mean(image)  # sums of squares of values close to zero are more accurate
+    image = image - offset
+    num_pixels = roi_size ** 2
+
+    sums = get_grid_sums(get_integral_image(image), roi_size, tops, lefts)
+    residual_sums, residual_sums_sq = sums, get_grid_sums(get_integral_image(image ** 2), roi_size, tops, lefts)
+    if detrend:
+        basis, fit, selection = get_detrending_matrices(roi_size)
+        moments = get_window_polynomial_moments(image, roi_size, tops, lefts)
+        weights = (moments @ fit.T) @ selection.T  # weights of the basis in the subtracted polynomial
+        residual_sums = sums - weights @ basis.sum(axis=0)
+        residual_sums_sq = residual_sums_sq - 2 * np.sum(moments * weights, axis=-1) + \
+            np.sum((weights @ (basis.T @ basis)) * weights, axis=-1)
+    variance = residual_sums_sq / num_pixels - (residual_sums / num_pixels) ** 2
+    return {
+        'mean': sums / num_pixels + offset,
+        'std': np.sqrt(np.maximum(variance, 0)),
+        'centers_x': lefts + roi_size / 2 - 0.5,
+        'centers_y': tops + roi_size / 2 - 0.5
+    }
+
+
+def create_roi(shape, size, center_x, center_y, name=None):
+    """ROI of the given shape ('square' or 'circle', any case) and size (side or diameter)"""
+    if str(shape).lower() == 'circle':
+        return CircleROI(size / 2, center_x, center_y, name)
+    elif str(shape).lower() == 'square':
+        return SquareROI(size, center_x, center_y, name)
+    raise NotImplementedError('ROI shape "{}" not supported'.format(shape))
+
+
 def roi_from_dict(roi_dict):
     if roi_dict is None:
         return None
-    if roi_dict['Shape'] == 'Circle':
-        return CircleROI(name=roi_dict['Name'], radius=roi_dict['Size']/2,
-                         center_x=roi_dict['Center X'], center_y=roi_dict['Center Y'])
-    elif roi_dict['Shape'] == 'Square':
-        return SquareROI(name=roi_dict['Name'], side=roi_dict['Size'],
-                         center_x=roi_dict['Center X'], center_y=roi_dict['Center Y'])
-    else:
-        raise NotImplemented('ROI shape "{}" not supported'.format(roi_dict['Shape']))
+    return create_roi(roi_dict['Shape'], roi_dict['Size'], roi_dict['Center X'], roi_dict['Center Y'],
+                      roi_dict.get('Name'))
 
@@ -1,9 +1,13 @@
 from enum import Enum
 import numpy as np
+from scipy.ndimage import label
 
 
 HUMIN = -999
 HUMAX = 24000
+SEG_UNASSIGNED = 255  # label of the pixels not belonging to any material in uint8 segmentation maps
+SEG_LUT_MAX_SIZE = 2 ** 20  # beyond this HU span segment_with_lut() compares the ranges one by one
+BODY_THRESHOLD_HU = -500  # pixels above this value can belong to the patient body
 
 
 # SEGMENTATION_MATERIALS
@@ -15,7 +19,7 @@ class SegMats(Enum):
     SOFT_TISSUE = 3
     BONE = 4
     METAL = 5
-    CUSTOM = 999
+    CUSTOM = 254  # last value fitting in uint8 segmentation maps (255 is SEG_UNASSIGNED)
 
 
 MAT_NAMES = {
@@ -50,3 +54,103 @@ def segment_with_thresholds(pixel_image, hu_ranges=HU_RANGES):
     for tissue, hu_range in hu_ranges.items():
         segm[(hu_range[0] < pixel_image) & (pixel_image < hu_range[1])] = tissue.value
     return segm
+
+
+def get_segmentation_lut(hu_ranges=HU_RANGES):
+    """
+    Lookup table from (integer) HU values to uint8 labels.
+
+    :return: the table and the HU value of its first element; the first and last elements are SEG_UNASSIGNED, so that
+             values outside the table can be clipped to them. None, None if the ranges do not allow a table.
+    """
+    bounds = [bound for hu_range in hu_ranges.values() for bound in hu_range]
+    if any(bound != int(bound) for bound in bounds) or max(bounds) - min(bounds) + 2 > SEG_LUT_MAX_SIZE:
+        return None, None
+    hu_offset = int(min(bounds)) - 1
+    lut = np.full(int(max(bounds)) - hu_offset + 1, SEG_UNASSIGNED, dtype=np.uint8)
+    for tissue, hu_range in hu_ranges.items():
+        lut[int(hu_range[0]) - hu_offset:int(hu_range[1]) - hu_offset] = tissue.value
+    return lut, hu_offset
+
+
+def segment_with_lut(pixel_image, hu_ranges=HU_RANGES, mask=None):
+    """
+    Segment an image (2D slice or 3D volume) into a uint8 map of SegMats values, in one vectorized pass.
+
+    Each range includes its lower bound and excludes its upper one, so that adjacent ranges (e.g. [-800, -300] and
+    [-300, 0]) have no gaps and no overlaps; where ranges overlap the last one wins. Pixels outside all the ranges
+    get SEG_UNASSIGNED. Integer bounds use a lookup table on the (floored and clipped) HU values.
+    If a mask (e.g. from get_body_mask()) is given, only its bounding box is processed and the pixels outside the mask
+    are unassigned.
+    """
+    pixel_image = np.asarray(pixel_image)
+    if mask is not None:
+        segm = np.full(pixel_image.shape, SEG_UNASSIGNED, dtype=np.uint8)
+        bbox = get_bounding_box(mask)
+        if bbox is not None:
+            segm[bbox] = np.where(mask[bbox], segment_with_lut(pixel_image[bbox], hu_ranges), SEG_UNASSIGNED)
+        return segm
+    lut, hu_offset = get_segmentation_lut(hu_ranges)
+    if lut is None:
+        segm = np.full(pixel_image.shape, SEG_UNASSIGNED, dtype=np.uint8)
+        for tissue, hu_range in hu_ranges.items():
+            segm[(hu_range[0] <= pixel_image) & (pixel_image < hu_range[1])] = tissue.value
+        return segm
+    if not np.issubdtype(pixel_image.dtype, np.integer):
+        pixel_image = np.floor(np.nan_to_num(pixel_image, nan=hu_offset))  # NaN pixels are unassigned
+    indexes = np.clip(pixel_image, hu_offset, hu_offset + lut.size - 1).astype(np.intp) - hu_offset
+    return lut[indexes]
+
+
+def get_body_mask(pixel_image, threshold_hu=BODY_THRESHOLD_HU):
+    """
+    Mask of the patient body: largest connected region above the threshold, with its holes (e.g. lungs) filled.
+
+    The table, the air around the patient and the burned-in annotations are excluded, as long as they do not touch
+    the body. Volumes (z, y, x) are processed slice by slice, but labelled and filled in a single pass.
+    """
+    pixel_image = np.asarray(pixel_image)
+    if pixel_image.ndim == 2:
+        return get_body_mask(pixel_image[np.newaxis], threshold_hu)[0]
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]  # in-plane connectivity only
+    regions, num_regions = label(pixel_image > threshold_hu, structure=structure)
+    if num_regions == 0:
+        return np.zeros(pixel_image.shape, dtype=bool)
+    region_sizes = np.bincount(regions.ravel())
+    region_slices = np.zeros(num_regions + 1, dtype=int)
+    region_slices[regions] = np.arange(pixel_image.shape[0])[:, np.newaxis, np.newaxis]
+    region_slices[0] = -1  # background
+    # the largest region of each slice (the first one in case of ties) is the last of its slice in this order
+    order = np.lexsort((-np.arange(num_regions + 1), region_sizes, region_slices))
+    is_largest = np.append(region_slices[order][1:] != region_slices[order][:-1], True)
+    selected = np.zeros(num_regions + 1, dtype=bool)
+    selected[order[is_largest]] = True
+    selected[0] = False
+    body = selected[regions]
+    # holes: regions of the background not touching the border of their slice (faster than binary_fill_holes)
+    background, _ = label(~body, structure=structure)
+    is_outside = np.zeros(background.max() + 1, dtype=bool)
+    for border in [background[:, 0, :], background[:, -1, :], background[:, :, 0], background[:, :, -1]]:
+        is_outside[border] = True
+    is_outside[0] = True  # body
+    return ~is_outside[background] | body
+
+
+def get_bounding_box(mask, margin=0):
+    """
+    Bounding box of the non-zero pixels of a mask, as a tuple of slices (one per axis) usable to crop the image.
+
+    :param margin: number of pixels added on each side of the last two axes (e.g. the radius of a kernel), within
+                   the image limits
+    :return: the tuple of slices, or None if the mask is empty
+    """
+    mask = np.asarray(mask)
+    if not mask.any():
+        return None
+    bbox = []
+    for axis in range(mask.ndim):
+        indexes = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        axis_margin = margin if axis >= mask.ndim - 2 else 0
+        bbox.append(slice(max(indexes[0] - axis_margin, 0), min(indexes[-1] + 1 + axis_margin, mask.shape[axis])))
+    return tuple(bbox)
@@ -1,7 +1,6 @@
 import math
 import numpy as np
 from actilib.helpers.math import radial_profile, find_x_of_threshold
-from actilib.analysis.rois import get_masked_image
 
 
 def esf2ttf(esf, bin_width, num_samples=256, hann_window=15):
@@ -57,10 +56,11 @@ def calculate_roi_ttf(images, roi, pixel_size_xy_mm):
     bgd = 0.0
     noi = 0.0
     for image in images:
-        mask_fgd = roi.get_annular_mask(image, radius_outer=roi.radius() * 0.9)
-        mask_bgd = roi.get_annular_mask(image, radius_inner=roi.radius() * 1.1, radius_outer=roi.radius() * 2)
-        image_masked_fgd = get_masked_image(image, mask_fgd)
-        image_masked_bgd = get_masked_image(image, mask_bgd)
+        crop_fgd, mask_fgd = roi.get_crop_and_mask(image, radius_outer=roi.radius() * 0.9)
+        crop_bgd, mask_bgd = roi.get_crop_and_mask(image, radius_inner=roi.radius() * 1.1,
+                                                   radius_outer=roi.radius() * 2)
+        image_masked_fgd = crop_fgd[mask_fgd]
+        image_masked_bgd = crop_bgd[mask_bgd]
         fgd += image_masked_fgd.mean() / len(images)
         std += image_masked_fgd.std() / len(images)
         bgd += image_masked_bgd.mean() / len(images)
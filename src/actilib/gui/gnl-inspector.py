@@ -245,6 +245,7 @@ class GNLInspector(QMainWindow):
                                                          hu_ranges={tissue: [self.spb_hu_min.value(),
                                                                              self.spb_hu_max.value()]},
                                                          return_plot_data=True)
+        segmap = np.ma.masked_equal(segmap, SEG_UNASSIGNED)  # only the segmented pixels are overlaid
         self.overlay_segmaps[self.slider.value() - 1] = segmap
         self.overlay_gnlmaps[self.slider.value() - 1] = gnlmap
         self.update_image()
@@ -34,6 +34,15 @@ def load_test_data():
     return json.loads(pkgutil.get_data('actilib', str(Path('resources') / 'test_data.json')).decode("utf-8"))
 
 
+def get_slice_position(dicom_header, default=None):
+    """Position of a slice along z [mm], from the DICOM header (default if not available)"""
+    if getattr(dicom_header, 'ImagePositionPatient', None) is not None:
+        return float(dicom_header.ImagePositionPatient[2])
+    if getattr(dicom_header, 'SliceLocation', None) is not None:
+        return float(dicom_header.SliceLocation)
+    return default
+
+
 def load_image_from_open_file(input_file):
     # image = {'header': None, 'pixels': None, 'source': 'path/to/file'}
     dicom_data = dcmread(input_file)
@@ -71,3 +80,24 @@ def load_images_from_directory(dir_path, sort_by_instance_number=True):
         images = sorted(images)
     return [couple[1] for couple in images]
 
+
+def load_header_from_open_file(input_file):
+    # header only, without reading the pixel data: {'header': ..., 'source': 'path/to/file'}
+    return {'header': dcmread(input_file, stop_before_pixels=True), 'source': input_file.name}
+
+
+def load_headers_from_tar(tar_path):
+    with tarfile.open(tar_path, encoding='utf-8') as file_tar:
+        return [load_header_from_open_file(file_tar.extractfile(file_name)) for file_name in file_tar.getmembers()]
+
+
+def load_headers_from_directory(dir_path, sort_by_instance_number=True):
+    images = []
+    for file_path in sorted(Path(dir_path).glob('*')):
+        if file_path.is_file():
+            with open(file_path, 'rb') as f:
+                image = load_header_from_open_file(f)
+                images.append((image['header'].InstanceNumber - 1, image))
+    if sort_by_instance_number:
+        images = sorted(images, key=lambda couple: couple[0])
+    return [couple[1] for couple in images]
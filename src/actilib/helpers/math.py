@@ -74,6 +74,38 @@ def subtract_2d_poly_mean(image):
     return image - (c[2] * x**2 + c[5] * x * y + c[6] * y**2 + c[1] * x + c[3] * y + c[0])
 
 
+def get_integral_image(image, margin=0):
+    """
+    Summed-area table of an image (or of a stack of images, on the last two axes).
+
+    The image is first padded symmetrically by margin pixels (same boundary as convolve2d(boundary='symm')); the table
+    has a leading row and column of zeros, so that sat[..., i, j] is the sum of padded[..., :i, :j].
+    Sums are accumulated in float64 whatever the image type.
+    """
+    image = np.asarray(image)
+    if margin > 0:
+        image = np.pad(image, [(0, 0)] * (image.ndim - 2) + [(margin, margin)] * 2, mode='symmetric')
+    sat = np.zeros(image.shape[:-2] + (image.shape[-2] + 1, image.shape[-1] + 1))
+    np.cumsum(image, axis=-2, dtype=np.float64, out=sat[..., 1:, 1:])
+    np.cumsum(sat[..., 1:, 1:], axis=-1, out=sat[..., 1:, 1:])
+    return sat
+
+
+def get_box_sums(sat, kernel_size, margin=0):
+    """
+    Sums over the kernel_size x kernel_size boxes centered on each pixel, from a table of get_integral_image().
+
+    The table must have been built with a margin at least kernel_size // 2; the result has the shape of the original
+    (not padded) image. Even kernels extend one pixel more before the center than after it, as in
+    convolve2d(mode='same'). The cost does not depend on the kernel size.
+    """
+    size_y, size_x = sat.shape[-2] - 1 - 2 * margin, sat.shape[-1] - 1 - 2 * margin
+    y0 = x0 = margin - kernel_size // 2
+    y1 = x1 = y0 + kernel_size
+    return sat[..., y1:y1 + size_y, x1:x1 + size_x] - sat[..., y0:y0 + size_y, x1:x1 + size_x] \
+        - sat[..., y1:y1 + size_y, x0:x0 + size_x] + sat[..., y0:y0 + size_y, x0:x0 + size_x]
+
+
 def get_polar_mesh(x, y=None):
     mesh_x, mesh_y = np.meshgrid(x, x if y is None else y)
     return cart2pol(mesh_x, mesh_y)
@@ -94,6 +126,12 @@ def smooth(x, window_size=5):
     return np.concatenate((start, out0, stop))
 
 
+def integrate_uniform(y, dx, axis=-1):
+    """Trapezoidal integral of samples with uniform spacing dx (also on numpy versions without trapz/trapezoid)"""
+    y = np.moveaxis(np.asarray(y), axis, -1)
+    return dx * (np.sum(y, axis=-1) - (y[..., 0] + y[..., -1]) / 2.0)
+
+
 def find_x_of_threshold(x, y, y_threshold):
     bin_thr = np.argmax((y - y_threshold) < 0)
     bin_min = max(bin_thr - 1, 0)
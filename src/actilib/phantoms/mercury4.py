@@ -1,9 +1,31 @@
+import json
 import math
+import re
 import cv2 as cv
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from scipy.ndimage import map_coordinates
 
-from actilib.helpers.math import cart2pol, pol2cart, deg_from_rad, find_circles
+from actilib.helpers.math import deg_from_rad
 from actilib.helpers.display import *
+from actilib.helpers.io import get_slice_position
+from actilib.analysis.rois import CircleROI, RoiSet, create_circle_of_rois, get_surrounding_average
+from actilib.analysis.nps import noise_properties
+from actilib.analysis.ttf import ttf_properties
+from actilib.analysis.detectability import get_dprime_default_params, calculate_dprime_table, get_values_dprime
+from actilib.analysis.profile import get_values_profile
+
+
+SECTION_DIAMETERS_MM = [160, 210, 260, 310, 360]
+INSERT_NAMES = {'air': 'Air', 'water': 'Water', 'bone': 'Bone', 'polystyrene': 'Polystyrene', 'iodine': 'Iodine'}
+NPS_ROI_SIZE_PX = 64
+INSERT_RADIUS_MM = 13
+INSERT_RING_RADIUS_MM = 45  # distance of the insert centers from the phantom center
+INSERT_CONTRAST_TOLERANCE_HU = 30
+GEOMETRY_VERSION = 1
+GEOMETRY_KEY_KEYWORDS = ['Manufacturer', 'ManufacturerModelName', 'DeviceSerialNumber', 'StationName', 'ProtocolName']
 
 
 def is_section_diameter(diameter_mm):
@@ -12,12 +34,26 @@ def is_section_diameter(diameter_mm):
     :param diameter_mm: the diameter as measured e.g. from an image [mm]
     :return: True if the diameter is compatible with that of a measurement section
     """
-    for d in [160, 210, 260, 310, 360]:
+    for d in SECTION_DIAMETERS_MM:
         if math.isclose(diameter_mm, d, abs_tol=3):
             return True
     return False
 
 
+def find_largest_contour_circle(pixel_windowed):
+    """Center [x, y] and radius of the largest enclosing circle of the contours of a windowed image (pixels)"""
+    ret, thr = cv.threshold(pixel_windowed.astype(np.uint8), 100, 255, 0)
+    contours, hierarchy = cv.findContours(thr, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
+    max_r = 0
+    [center_x, center_y] = [0, 0]
+    for c in contours:
+        [x, y], r = cv.minEnclosingCircle(c)
+        if r > max_r:
+            max_r = r
+            [center_x, center_y] = [x, y]
+    return [center_x, center_y], max_r
+
+
 def find_phantom_center_and_radius(dicom_images):
     if not isinstance(dicom_images, list):
         dicom_images = [dicom_images]
@@ -25,16 +61,8 @@ def find_phantom_center_and_radius(dicom_images):
     centers_y = []
     radii = []
     for dicom_image in dicom_images:
-        pixel_windowed = apply_windowing(dicom_image['pixels'], dicom_image['header'])
-        ret, thr = cv.threshold(pixel_windowed.astype(np.uint8), 100, 255, 0)
-        contours, hierarchy = cv.findContours(thr, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE)
-        max_r = 0
-        [center_x, center_y] = [0, 0]
-        for c in contours:
-            [x, y], r = cv.minEnclosingCircle(c)
-            if r > max_r:
-                max_r = r
-                [center_x, center_y] = [x, y]
+        [center_x, center_y], max_r = find_largest_contour_circle(apply_windowing(dicom_image['pixels'],
+                                                                                  dicom_image['header']))
         centers_x.append(center_x)
         centers_y.append(center_y)
         radii.append(max_r)
@@ -45,84 +73,124 @@ def find_phantom_center_and_radius(dicom_images):
     return ret_xy, ret_r, np.multiply(ret_xy, pixel_size_xy_mm), ret_r * radius_factor_mm
 
 
-def find_inserts(image, phantom_center_px, radius_factor_mm, expected_hu, tolerance_hu=100):
-    expected_radius_px = int(13 / radius_factor_mm)
-    expected_dfc = int(45 / radius_factor_mm)  # distance from center
-    pixels = image['pixels'].copy()
-    pixels[pixels < expected_hu - tolerance_hu] = expected_hu - tolerance_hu
-    pixels[pixels > expected_hu + tolerance_hu] = expected_hu + tolerance_hu
-    found_circles = find_circles(pixels, expected_radius_px, tolerance_px=1)
-    dfc_tol_px = 3
-    return_circles = []
-    for circle in found_circles:
-        dfc = ((circle[0]-phantom_center_px[0])**2 + (circle[1]-phantom_center_px[1])**2)**0.5
-        if expected_dfc - dfc_tol_px < dfc < expected_dfc + dfc_tol_px:
-            return_circles.append(circle)
-    if len(return_circles) == 0:
+def get_insert_template(shape, pixel_size_xy_mm, radius_mm=INSERT_RADIUS_MM):
+    """
+    Fourier transform of the insert template for the cross-correlation of images of the given shape: mean of a disk of
+    the insert radius minus mean of the surrounding annulus (up to 1.5 times the radius), centred on the origin.
+    The correlation is then the local contrast of an insert [HU], independent of the background level.
+    """
+    yy = np.fft.fftfreq(shape[0], 1 / shape[0])[:, np.newaxis] * pixel_size_xy_mm[1]
+    xx = np.fft.fftfreq(shape[1], 1 / shape[1])[np.newaxis, :] * pixel_size_xy_mm[0]
+    rr = np.hypot(xx, yy)
+    disk = rr <= radius_mm
+    annulus = (rr > radius_mm) & (rr <= 1.5 * radius_mm)
+    return np.conj(np.fft.rfft2(disk / np.sum(disk) - annulus / np.sum(annulus)))
+
+
+def get_peak_offset(values):
+    """Sub-pixel offset of the peak of three values centred on the maximum (parabolic interpolation)"""
+    denominator = values[0] - 2 * values[1] + values[2]
+    return 0.5 * (values[0] - values[2]) / denominator if denominator < 0 else 0
+
+
+def assign_ring_inserts(contrasts, contrast_tolerance_hu=INSERT_CONTRAST_TOLERANCE_HU):
+    """
+    Names of the five inserts on the ring from their contrasts, sorted by angle: bone has the highest contrast, air
+    the lowest, and around the ring there are iodine, polystyrene, bone, water and air (in one of the two directions).
+    :return: a dictionary {insert name: index in contrasts}, or None if the contrasts do not fit the phantom
+    """
+    i_bone, i_air = int(np.argmax(contrasts)), int(np.argmin(contrasts))
+    step = {2: 1, 3: -1}.get((i_air - i_bone) % 5)
+    if step is None:
         return None
-    return return_circles
-
-
-def calculate_intermediate_insert(insertA, insertB, center_xy):
-    thetaA, rhoA = cart2pol(insertA[0] - center_xy[0], insertA[1] - center_xy[1])
-    thetaB, rhoB = cart2pol(insertB[0] - center_xy[0], insertB[1] - center_xy[1])
-    theta_step = 0.4 * math.pi  # 1/5 of full circle is the angular spacing between inserts
-    if thetaA < 0:
-        thetaA = 2 * math.pi + thetaA
-    if thetaB < 0:
-        thetaB = 2 * math.pi + thetaB
-    if math.isclose(thetaA + 2 * theta_step, thetaB, abs_tol=0.1):
-        thetaI = thetaA + theta_step
+    indexes = {'bone': i_bone, 'air': i_air, 'iodine': (i_bone - 2 * step) % 5,
+               'polystyrene': (i_bone - step) % 5, 'water': (i_bone + step) % 5}
+    if contrasts[indexes['iodine']] < contrast_tolerance_hu:
+        return None
+    if any(abs(contrasts[i]) < contrast_tolerance_hu for i in indexes.values()):  # inserts not clearly visible
+        return None
+    return indexes
+
+
+def find_ring_inserts(pixels, center_xy, pixel_size_xy_mm, contrast_tolerance_hu=INSERT_CONTRAST_TOLERANCE_HU,
+                      angle_deg=None):
+    """
+    Find the five inserts of a TTF section by cross-correlation with a disk template (see get_insert_template()).
+
+    A window around the phantom center is correlated once in the Fourier domain, then the response is sampled along
+    the ring of the inserts: the five inserts are 72 degrees apart, so their angle is the one maximizing the total
+    absolute contrast of five equally spaced points. The positions are finally refined around each point.
+    :param pixels: an image (y, x) or a batch of images (z, y, x), processed with a single FFT
+    :param center_xy: the phantom center [x, y] in pixels, or a list with one center per image
+    :param contrast_tolerance_hu: minimum absolute contrast of each insert
+    :param angle_deg: angle of the bone insert [deg] from a previous detection (see get_section_geometry()): only the
+                      inserts at this angle are verified and refined, without searching the whole ring
+    :return: a dictionary {insert name: [x, y, r]} in pixels, or None if the inserts are not all clearly visible.
+             For a batch, a list with one result per image.
+    """
+    pixels = np.asarray(pixels, dtype=float)
+    is_batch = pixels.ndim == 3
+    if not is_batch:
+        pixels = pixels[np.newaxis]
+    centers_xy = np.broadcast_to(np.asarray(center_xy, dtype=float), (len(pixels), 2))
+    pixel_size_xy_mm = np.array(pixel_size_xy_mm, dtype=float)
+    half_xy = np.ceil((INSERT_RING_RADIUS_MM + 1.5 * INSERT_RADIUS_MM) / pixel_size_xy_mm).astype(int) + 4
+    shape = (2 * half_xy[1] + 1, 2 * half_xy[0] + 1)
+    windows = np.empty((len(pixels),) + shape)
+    origins_xy = np.round(centers_xy).astype(int) - half_xy
+    for window, image, (x0, y0) in zip(windows, pixels, origins_xy):
+        crop = image[max(y0, 0):y0 + shape[0], max(x0, 0):x0 + shape[1]]
+        window.fill(np.mean(crop) if crop.size else 0)  # any level outside the image, the template has zero sum
+        window[max(-y0, 0):max(-y0, 0) + crop.shape[0], max(-x0, 0):max(-x0, 0) + crop.shape[1]] = crop
+    template = get_insert_template(shape, pixel_size_xy_mm)
+    responses = np.fft.irfft2(np.fft.rfft2(windows) * template, s=shape)
+    # response along the ring, then the best angle of five equally spaced inserts
+    num_angles = 5 * 72
+    angles = np.arange(num_angles) * 2 * math.pi / num_angles
+    ring_xy = (centers_xy - origins_xy)[:, :, np.newaxis] + INSERT_RING_RADIUS_MM \
+        * np.array([np.cos(angles), np.sin(angles)])[np.newaxis] / pixel_size_xy_mm[np.newaxis, :, np.newaxis]
+    slice_indexes = np.broadcast_to(np.arange(len(pixels))[:, np.newaxis], (len(pixels), num_angles))
+    profiles = map_coordinates(responses, [slice_indexes, ring_xy[:, 1], ring_xy[:, 0]], order=1)
+    if angle_deg is None:
+        offsets = np.argmax(np.sum(np.abs(profiles.reshape(len(pixels), 5, -1)), axis=1), axis=1)
     else:
-        thetaI = thetaA - theta_step
-    if thetaI > math.pi:
-        thetaI = thetaI - 2 * math.pi
-    x, y = pol2cart(thetaI, rhoA/2 + rhoB/2)
-    r = insertA[2]/2 + insertB[2]/2
-    return [x + center_xy[0], y + center_xy[1], r]
+        i_angle = int(round(angle_deg * num_angles / 360)) % num_angles
+        offsets = np.full(len(pixels), i_angle % (num_angles // 5))
+    radius_factor_mm = ((pixel_size_xy_mm[0] ** 2 + pixel_size_xy_mm[1] ** 2) / 2) ** 0.5
+    search_px = 3
+    results = []
+    for response, profile, offset, ring, (x0, y0) in zip(responses, profiles, offsets, ring_xy, origins_xy):
+        indexes = offset + np.arange(5) * (num_angles // 5)
+        names = assign_ring_inserts(profile[indexes], contrast_tolerance_hu)
+        if names is None or (angle_deg is not None and indexes[names['bone']] != i_angle):
+            results.append(None)
+            continue
+        inserts = {}
+        for name, i in names.items():
+            sign = np.sign(profile[indexes[i]])
+            ix, iy = int(round(ring[0, indexes[i]])), int(round(ring[1, indexes[i]]))
+            neighbourhood = sign * response[iy - search_px:iy + search_px + 1, ix - search_px:ix + search_px + 1]
+            py, px = np.unravel_index(np.argmax(neighbourhood), neighbourhood.shape)
+            py, px = min(max(py, 1), 2 * search_px - 1), min(max(px, 1), 2 * search_px - 1)
+            x = ix - search_px + px + get_peak_offset(neighbourhood[py, px - 1:px + 2])
+            y = iy - search_px + py + get_peak_offset(neighbourhood[py - 1:py + 2, px])
+            inserts[name] = [x0 + x, y0 + y, INSERT_RADIUS_MM / radius_factor_mm]
+        results.append(inserts)
+    return results if is_batch else results[0]
 
 
-def section_has_inserts(image, center_xy=None):
-    print('----------------------------')
+def find_section_inserts(image, center_xy=None):
+    """
+    Find the five inserts of a TTF section (see find_ring_inserts()).
+    :return: a dictionary {insert name: [x, y, r]} in pixels, or None if the inserts are not all clearly visible
+    """
     if center_xy is None:
         center_xy, _, _, _ = find_phantom_center_and_radius(image)
-    pixel_size_xy_mm = image['header'].PixelSpacing
-    radius_factor_mm = ((pixel_size_xy_mm[0] ** 2 + pixel_size_xy_mm[1] ** 2) / 2) ** 0.5
-    # windowing on bone
-    ins_bone = find_inserts(image, center_xy, radius_factor_mm, 400)  # bone insert
-    ins_b_na = find_inserts(image, center_xy, radius_factor_mm, 150)  # bone insert + iodine
-    ins_air = find_inserts(image, center_xy, radius_factor_mm, -250)  # air insert
-    # first esclusion rule: not enough clear inserts found
-    if not ins_bone or not ins_b_na or not ins_air or len(ins_bone) != 1 or len(ins_b_na) != 2 or len(ins_air) != 1:
-        return False
-    # now we calculate the positions of the other three and we check if they are distinguishable from background
-    ins_coords = {
-        'bone': ins_bone[0],
-        'air': ins_air[0]
-    }
-    for insert in ins_b_na:
-        if math.isclose(ins_b_na[0][0], ins_coords['bone'][0], abs_tol=3) \
-                and math.isclose(ins_b_na[0][1], ins_coords['bone'][1], abs_tol=3):
-            ins_coords['iodine'] = ins_b_na[1]
-        else:
-            ins_coords['iodine'] = ins_b_na[0]
-    # use polar coordinates to determine position of the other inserts
-    # note that y coordinate goes from top to bottom: theta = 0 is at 3 o' clock and grows clockwise
-    ins_coords['polystyrene'] = calculate_intermediate_insert(ins_b_na[0], ins_b_na[1], center_xy)
-    ins_coords['water'] = calculate_intermediate_insert(ins_bone[0], ins_air[0], center_xy)
-    # are the two low contrast inserts visible?
-    from actilib.analysis.rois import PixelROI
-    # reference ROI for background
-    ref_ins = np.average([ins_coords['air'], ins_coords['water']], axis=0)
-    ref_roi = PixelROI(ref_ins[0], ref_ins[1], ref_ins[2], shape='circular')
-    ref_mean = ref_roi.get_mask_mean(image['pixels'])
-    for name, ins in ins_coords.items():
-        roi = PixelROI(ins[0], ins[1], ins[2], shape='circular')
-        mean = roi.get_mask_mean(image['pixels'])
-        if math.isclose(mean, ref_mean, abs_tol=30):
-            print('Insert {} not clearly visible (HU contrast: {})'.format(name, int(ref_mean - mean)))
-            return False
-    return True
+    return find_ring_inserts(image['pixels'], center_xy, image['header'].PixelSpacing)
+
+
+def section_has_inserts(image, center_xy=None):
+    return find_section_inserts(image, center_xy) is not None
 
 
 def section_is_uniform(image, cxy, cr):
@@ -157,29 +225,333 @@ def section_is_uniform(image, cxy, cr):
     return True
 
 
-def classify_slices(images):
+def classify_slice(image, geometry=None):
+    """
+    Classify one image of a Mercury Phantom v. 4.0 scan, from the cheapest to the most expensive check.
+    With a phantom geometry from a previous scan (see get_phantom_geometry()), the inserts are first looked for where
+    they were (verify_section_inserts()) and searched only if not there.
+    :return: the flag ('N', 'T' or 'x'), the phantom center [x, y] and radius in pixels and the radius in mm
+    """
+    pixel_size_xy_mm = np.array(image['header'].PixelSpacing)
+    cxy, r = find_largest_contour_circle(apply_windowing(image['pixels'], image['header']))
+    r_mm = r * ((pixel_size_xy_mm[0] ** 2 + pixel_size_xy_mm[1] ** 2) / 2) ** 0.5
+    # most restrictive condition: we must be in one of the 5 regions of fixed diameter (16/21/26/31/36 cm)
+    if not is_section_diameter(r_mm * 2):
+        return 'x', cxy, r, r_mm
+    # NPS - region must be uniform (a cheap check, and uniform sections have no inserts)
+    if section_is_uniform(image, cxy, r):
+        return 'N', cxy, r, r_mm
+    # TTF - second most restrictive condition
+    section = geometry['ttf'].get(get_diameter_key(get_nominal_diameter(r_mm * 2))) if geometry else None
+    if section is not None and verify_section_inserts(image, section, cxy):
+        return 'T', cxy, r, r_mm
+    if section_has_inserts(image, cxy):
+        return 'T', cxy, r, r_mm
+    return 'x', cxy, r, r_mm
+
+
+def get_sampling_step(images, sampling_mm):
+    """Number of slices corresponding to a distance along z, from the positions in the headers (at least 1)"""
+    positions = [get_slice_position(image['header']) for image in images]
+    if len(images) < 2 or None in positions:
+        return 1
+    spacing_mm = abs(float(np.median(np.diff(positions))))
+    return max(1, int(sampling_mm / spacing_mm)) if spacing_mm > 0 else 1
+
+
+def classify_slices(images, max_workers=1, use_threads=False, return_geometry=False, sampling_mm=None,
+                    phantom_geometry=None):
     """
     Classify the images assuming that they describe the scan of a Mercury Phantom v. 4.0
     :param images: a list of images, each one corresponding to a DICOM pixel_array
+    :param max_workers: number of parallel workers (None: number of processors, 1: serial)
+    :param return_geometry: also return the phantom center [x, y] and radius of each image [px], as calculated during
+                            the classification (None for the images not examined)
+    :param sampling_mm: if given, only one image every sampling_mm along z is examined (images must be sorted by
+                        position) and the boundaries between runs of equal flags are then found by bisection. The
+                        flags are identical to those of examining all the images only if every run of equal flags
+                        spans at least sampling_mm; shorter runs (e.g. a single transition slice) can be missed
+    :param phantom_geometry: the phantom geometry of a previous scan, if available (see classify_slice())
     :return: a list of flags with image classification: 'N' = Noise, 'T' = TTF and 'x' = none of them
     """
-    flags = ['x'] * len(images)
-    for i, image in enumerate(images):
-        cxy, r, cxy_mm, r_mm = find_phantom_center_and_radius(image)
-        # print(cxy, r, cxy_mm, r_mm)
-        # most restrictive condition: we must be in one of the 5 regions of fixed diameter (16/21/26/31/36 cm)
-        if not is_section_diameter(r_mm * 2):
-            continue  # default flag is 'x'
-        # TTF - second most restrictive condition
-        if section_has_inserts(image, cxy):
-            flags[i] = 'T'
-            continue
-        # NPS - region must be uniform
-        if section_is_uniform(image, cxy, r):
-            flags[i] = 'N'
-            continue
+    results = [None] * len(images)
+    classify_one = partial(classify_slice, geometry=phantom_geometry)
+    executor = None
+    if max_workers != 1:
+        executor = (ThreadPoolExecutor if use_threads else ProcessPoolExecutor)(max_workers=max_workers)
+
+    def classify(indexes):
+        indexes = [i for i in indexes if results[i] is None]
+        selected = [images[i] for i in indexes]
+        for i, result in zip(indexes, executor.map(classify_one, selected) if executor else
+                             map(classify_one, selected)):
+            results[i] = result
+
+    try:
+        step = 1 if sampling_mm is None else get_sampling_step(images, sampling_mm)
+        samples = sorted(set(range(0, len(images), step)) | {len(images) - 1}) if images else []
+        classify(samples)
+        intervals = [(a, b) for a, b in zip(samples[:-1], samples[1:]) if b - a > 1 and results[a][0] != results[b][0]]
+        while intervals:  # bisection of the intervals containing a boundary, all the middle slices at once
+            middles = [int((a + b) / 2) for a, b in intervals]
+            classify(middles)
+            intervals = [(i1, i2) for (a, b), m in zip(intervals, middles) for i1, i2 in [(a, m), (m, b)]
+                         if i2 - i1 > 1 and results[i1][0] != results[i2][0]]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    flags = []
+    for result in results:  # images not examined belong to the run of the previous examined image
+        flags.append(result[0] if result is not None else flags[-1])
+    if return_geometry:
+        return flags, [result[1] if result else None for result in results], \
+            [result[2] if result else None for result in results]
     return flags
 
 
+def get_nominal_diameter(diameter_mm):
+    """Closest of the 5 section diameters [mm]"""
+    return min(SECTION_DIAMETERS_MM, key=lambda d: abs(d - diameter_mm))
+
+
+def get_diameter_key(diameter_mm):
+    return 'd{}mm'.format(diameter_mm)  # as in imQuest results, e.g. 'd260mm'
+
+
+def get_sections(flags, radii_mm):
+    """
+    Group the slices classified as 'N' or 'T' by flag and section diameter.
+    :return: a dictionary {(flag, diameter_mm): list of slice indexes}, sorted by diameter
+    """
+    sections = {}
+    run = []
+    for i, flag in enumerate(list(flags) + ['x']):
+        if run and flag != flags[run[0]]:  # a run of equal flags has ended
+            if flags[run[0]] in ['N', 'T']:
+                diameter_mm = get_nominal_diameter(2 * np.median([radii_mm[j] for j in run if radii_mm[j] is not None]))
+                sections.setdefault((flags[run[0]], diameter_mm), []).extend(run)
+            run = []
+        run.append(i)
+    return dict(sorted(sections.items(), key=lambda item: (item[0][1], item[0][0])))
+
+
+def create_section_nps_rois(center_xy, radius_px, roi_size_px=NPS_ROI_SIZE_PX, num_rois=4):
+    """Ring of square ROIs placed at half of the radius of a uniform section"""
+    return create_circle_of_rois(num_rois, roi_size_px, radius_px / 2, center_xy[0], center_xy[1], 45)
+
+
+def calculate_section_nps(dicom_images, rois):
+    """NPS of a uniform section, averaged over the ROIs (see create_section_nps_rois())"""
+    images = [image for _ in rois for image in dicom_images]
+    return noise_properties(images, [roi for roi in rois for _ in dicom_images])
+
+
+def locate_section_inserts(dicom_images, center_xy, angle_deg=None):
+    """
+    Inserts of a section, averaged over the slices where they are found (see find_ring_inserts()).
+    If the angle of the bone insert is known, the inserts are verified and refined there, and searched on the whole
+    ring only if not found.
+    :return: a list of CircleROI named as the inserts, or None if the inserts are not found
+    """
+    pixels = [image['pixels'] for image in dicom_images]
+    pixel_size_xy_mm = dicom_images[0]['header'].PixelSpacing
+    found = [inserts for inserts in find_ring_inserts(pixels, center_xy, pixel_size_xy_mm, angle_deg=angle_deg)
+             if inserts is not None]
+    if not found and angle_deg is not None:
+        return locate_section_inserts(dicom_images, center_xy)
+    if not found:
+        return None
+    inserts = {name: np.mean([inserts[name] for inserts in found], axis=0) for name in found[0]}  # over the slices
+    return [CircleROI(insert[2], insert[0], insert[1], name) for name, insert in inserts.items()]
+
+
+def calculate_section_ttf(dicom_images, rois):
+    """TTF of each insert of a section: {insert name: TTF result}, from the ROIs of locate_section_inserts()"""
+    return {INSERT_NAMES[roi.name()]: ttf_properties(dicom_images, roi) for roi in rois}
+
+
+def _section_job(job):
+    flag, dicom_images, center_xy, radius_px, section = job
+    if flag == 'N':
+        rois = get_section_rois(section, center_xy) if section else create_section_nps_rois(center_xy, radius_px)
+        return calculate_section_nps(dicom_images, rois), rois
+    rois = locate_section_inserts(dicom_images, center_xy, section['insert_angles_deg']['bone'] if section else None)
+    return (calculate_section_ttf(dicom_images, rois), rois) if rois else (None, None)
+
+
+def get_section_geometry(center_xy, radius_px, rois, pixel_size_xy_mm):
+    """
+    Geometry of a section: center and radius [px] and ROI templates, with centers relative to the section center (as
+    PixelROI.as_dict()). For the inserts, also their angles [deg] around the section center.
+    """
+    roi_set = RoiSet.from_rois(rois)
+    roi_set.centers_x -= center_xy[0]
+    roi_set.centers_y -= center_xy[1]
+    section = {'center_xy': [float(c) for c in center_xy], 'radius_px': float(radius_px), 'rois': roi_set.as_dicts()}
+    if roi_set.names is not None and all(name in INSERT_NAMES for name in roi_set.names):
+        section['insert_angles_deg'] = {
+            name: deg_from_rad(math.atan2(dy * pixel_size_xy_mm[1], dx * pixel_size_xy_mm[0]))
+            for name, dx, dy in zip(roi_set.names, roi_set.centers_x.tolist(), roi_set.centers_y.tolist())}
+    return section
+
+
+def get_section_rois(section, center_xy):
+    """ROIs of a section geometry (see get_section_geometry()) placed around the given section center"""
+    roi_set = RoiSet.from_dicts(section['rois'])
+    roi_set.centers_x += center_xy[0]
+    roi_set.centers_y += center_xy[1]
+    return roi_set.to_rois()
+
+
+def verify_section_inserts(image, section, center_xy, contrast_tolerance_hu=INSERT_CONTRAST_TOLERANCE_HU):
+    """
+    Check that the inserts of a section geometry are visible in an image, in the same order around the ring.
+    Cheap: only the means of the insert ROIs and of their surroundings are calculated.
+    """
+    angles_deg = section['insert_angles_deg']
+    rois = sorted(get_section_rois(section, center_xy), key=lambda roi: angles_deg[roi.name()] % 360)
+    contrasts = [roi.get_masked_mean(image['pixels']) - get_surrounding_average(image['pixels'], roi, roi.size() / 4)
+                 for roi in rois]
+    names = assign_ring_inserts(contrasts, contrast_tolerance_hu)
+    return names is not None and all(rois[i].name() == name for name, i in names.items())
 
 
+def get_geometry_key(dicom_header):
+    """Identifier of the scanner and protocol of a series, e.g. to name the cached phantom geometry"""
+    values = [str(getattr(dicom_header, keyword, '') or '') for keyword in GEOMETRY_KEY_KEYWORDS]
+    return '_'.join(re.sub(r'[^A-Za-z0-9.]+', '-', value).strip('-') or 'none' for value in values)
+
+
+def get_phantom_geometry(dicom_header, sections, previous_geometry=None):
+    """
+    Phantom geometry model of a scanner and protocol: ROI templates of the uniform ('nps') and insert ('ttf') sections
+    of each diameter. Serialisable to JSON (see save_phantom_geometry()).
+    :param sections: a dictionary {(flag, diameter_mm): section geometry} (see get_section_geometry())
+    :param previous_geometry: sections of a previous geometry not found in this scan are kept
+    """
+    geometry = {'version': GEOMETRY_VERSION, 'key': get_geometry_key(dicom_header),
+                'pixel_size_xy_mm': [float(p) for p in dicom_header.PixelSpacing], 'nps': {}, 'ttf': {}}
+    if previous_geometry is not None:
+        geometry['nps'].update(previous_geometry['nps'])
+        geometry['ttf'].update(previous_geometry['ttf'])
+    for (flag, diameter_mm), section in sections.items():
+        geometry['nps' if flag == 'N' else 'ttf'][get_diameter_key(diameter_mm)] = section
+    return geometry
+
+
+def is_geometry_compatible(geometry, dicom_header):
+    return geometry is not None and geometry.get('version') == GEOMETRY_VERSION \
+        and np.allclose(geometry['pixel_size_xy_mm'], np.array(dicom_header.PixelSpacing, dtype=float))
+
+
+def get_geometry_cache_path(cache_dir, dicom_header):
+    return Path(cache_dir) / '{}.json'.format(get_geometry_key(dicom_header))
+
+
+def save_phantom_geometry(geometry, file_path):
+    with open(file_path, 'w') as fout:
+        json.dump(geometry, fout, indent=4)
+
+
+def load_phantom_geometry(file_path):
+    """The phantom geometry saved in a file, or None if the file does not exist"""
+    if not Path(file_path).is_file():
+        return None
+    with open(file_path, 'r') as fin:
+        return json.load(fin)
+
+
+def analyze_mercury_phantom(dicom_images, dprime_params=None, max_workers=None, use_threads=False, sampling_mm=None,
+                            phantom_geometry=None, geometry_cache_dir=None, return_geometry=False):
+    """
+    Full analysis of a scan of the Mercury Phantom v. 4.0: slice classification, NPS of each uniform section, TTF of
+    each insert of each section with inserts, d' with its exponential fit vs the diameter, and longitudinal profiles.
+
+    Sections are processed in parallel (see classify_slices() for max_workers, use_threads and sampling_mm).
+    :param dicom_images: the images of the series, sorted by position
+    :param dprime_params: d' parameters (default: get_dprime_default_params()); the task contrast is that of each insert
+    :param phantom_geometry: the phantom geometry of a previous scan with the same scanner and protocol: the sections
+                             are verified and refined instead of detected from scratch (see get_phantom_geometry())
+    :param geometry_cache_dir: directory where the phantom geometry is loaded from (if phantom_geometry is not given)
+                               and saved to, one file per scanner and protocol (see get_geometry_key())
+    :param sampling_mm: examine one image every sampling_mm along z to classify the slices (see classify_slices()):
+                        every section and every run of transition slices must span at least sampling_mm, otherwise
+                        shorter runs can be missed and the results differ from those without sampling
+    :param return_geometry: also return the updated phantom geometry
+    :return: a dictionary with the same structure of the imQuest results (see resources/matlab/save_json_results.m):
+             'info_phantom', 'values_slices', 'values_profile', 'values_nps', 'values_ttf', 'values_dprime' and
+             'values_freq'
+    """
+    header = dicom_images[0]['header']
+    cache_path = get_geometry_cache_path(geometry_cache_dir, header) if geometry_cache_dir is not None else None
+    if phantom_geometry is None and cache_path is not None:
+        phantom_geometry = load_phantom_geometry(cache_path)
+    if not is_geometry_compatible(phantom_geometry, header):
+        phantom_geometry = None
+    flags, centers_xy, radii_px = classify_slices(dicom_images, max_workers, use_threads, True, sampling_mm,
+                                                  phantom_geometry)
+    pixel_size_xy_mm = np.array(dicom_images[0]['header'].PixelSpacing, dtype=float)
+    radius_factor_mm = ((pixel_size_xy_mm[0] ** 2 + pixel_size_xy_mm[1] ** 2) / 2) ** 0.5
+    radii_mm = [r * radius_factor_mm if r is not None else None for r in radii_px]
+    sections = get_sections(flags, radii_mm)
+    jobs = []
+    for (flag, diameter_mm), indexes in sections.items():
+        examined = [i for i in indexes if centers_xy[i] is not None]
+        center_xy = np.mean([centers_xy[i] for i in examined], axis=0).tolist()
+        radius_px = float(np.mean([radii_px[i] for i in examined]))
+        section = phantom_geometry['nps' if flag == 'N' else 'ttf'].get(get_diameter_key(diameter_mm)) \
+            if phantom_geometry else None
+        jobs.append((flag, [dicom_images[i] for i in indexes], center_xy, radius_px, section))
+    if max_workers == 1:
+        results = list(map(_section_job, jobs))
+    else:
+        executor_class = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+        with executor_class(max_workers=max_workers) as executor:
+            results = list(executor.map(_section_job, jobs))
+    nps_results, ttf_results, section_geometries = {}, {}, {}
+    for ((flag, diameter_mm), _), job, (result, rois) in zip(sections.items(), jobs, results):
+        if result is None:
+            continue
+        section_geometries[(flag, diameter_mm)] = get_section_geometry(job[2], job[3], rois, pixel_size_xy_mm)
+        if flag == 'N':
+            nps_results[get_diameter_key(diameter_mm)] = result
+        else:
+            for insert, ttf in result.items():
+                ttf_results.setdefault(insert, {})[get_diameter_key(diameter_mm)] = ttf
+    params = get_dprime_default_params() if dprime_params is None else dprime_params
+    dprime_table = calculate_dprime_table(nps_results, ttf_results, params, max_workers=max_workers,
+                                          use_threads=use_threads)
+    any_nps = next(iter(nps_results.values()), None)
+    any_ttf = next((ttf for ttf_by_section in ttf_results.values() for ttf in ttf_by_section.values()), None)
+    geometry = get_phantom_geometry(header, section_geometries, phantom_geometry)
+    if cache_path is not None:
+        save_phantom_geometry(geometry, cache_path)
+    results = {
+        'info_phantom': {
+            'name': 'Mercury Phantom',
+            'version': 4,
+            'diameters_mm': sorted(set(diameter_mm for _, diameter_mm in sections)),
+            'insert_names': list(ttf_results.keys()),
+            'nyquist_frequencies': {'fx': 0.5 / pixel_size_xy_mm[0], 'fy': 0.5 / pixel_size_xy_mm[1]}
+        },
+        'values_slices': {
+            'z': [get_slice_position(image['header'], i) for i, image in enumerate(dicom_images)],
+            'is_nps': [flag == 'N' for flag in flags],
+            'is_ttf': [flag == 'T' for flag in flags]
+        },
+        'values_profile': get_values_profile(dicom_images),
+        'values_nps': {key: {'fav': nps['fmean'], 'fpeak': nps['fpeak'], 'noise': nps['noise'], 'NPS': nps['nps_1d'],
+                             'NPS_2D': nps['nps_2d']} for key, nps in nps_results.items()},
+        'values_ttf': {insert: {key: {'ESF': ttf['esf'], 'LSF': ttf['lsf'], 'TTF': ttf['ttf'],
+                                      'contrast': ttf['contrast'], 'f10': ttf['f10'], 'f50': ttf['f50']}
+                                for key, ttf in ttf_by_section.items()}
+                       for insert, ttf_by_section in ttf_results.items()},
+        'values_dprime': get_values_dprime(dprime_table) if dprime_table else {},
+        'values_freq': {
+            'nps_fx': any_nps['f2d_x'] if any_nps else [],
+            'nps_fy': any_nps['f2d_y'] if any_nps else [],
+            'nps_f': any_nps['f1d'] if any_nps else [],
+            'ttf_f': any_ttf['frq'] if any_ttf else []
+        }
+    }
+    return (results, geometry) if return_geometry else results
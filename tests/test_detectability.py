@@ -0,0 +1,132 @@
+import numpy as np
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from actilib.helpers.math import get_polar_mesh
+from actilib.analysis.detectability import get_dprime_default_params, calculate_dprime, calculate_dprime_sweep, \
+    calculate_dprime_from_spectra, calculate_task_freq, calculate_task_image, get_eye_filter, resample_2d_nps, \
+    resample_2d_ttf, get_data_freq, clear_nps_resampling_cache, calculate_dprime_table, fit_dprime_vs_diameter, \
+    get_values_dprime
+from actilib.helpers.io import load_test_data
+
+
+def synthetic_nps(noise=10.0, fft_samples=128, pixel_size_mm=0.77):
+    freq = np.fft.fftshift(np.fft.fftfreq(fft_samples, pixel_size_mm))
+    _, mesh_r = get_polar_mesh(freq)
+    f1d = np.linspace(0, np.max(mesh_r), fft_samples)
+    return {
+        'noise': noise,
+        'f1d': f1d.tolist(),
+        'f2d_x': freq.tolist(),
+        'f2d_y': freq.tolist(),
+        'nps_1d': (f1d * np.exp(-f1d / 0.15)).tolist(),
+        'nps_2d': (mesh_r * np.exp(-mesh_r / 0.15)).tolist()
+    }
+
+
+def synthetic_ttf(f50=0.35):
+    frq = np.linspace(0, 2.0, 256)
+    return {'frq': frq.tolist(), 'ttf': np.exp(-np.log(2) * frq / f50).tolist(), 'contrast': 100.0}
+
+
+class TestDetectability(unittest.TestCase):
+    nps = synthetic_nps()
+    ttf = synthetic_ttf()
+
+    def test_dprime_sweep(self):
+        params = get_dprime_default_params()
+        diameters = [2, 5, 10]
+        contrasts = [-15, 50]
+        profiles = ['Flat', 'Gaussian', 'Ogive']
+        sweep = calculate_dprime_sweep(self.nps, self.ttf, diameters, contrasts, profiles, params)
+        self.assertEqual(sweep['dprime'].shape, (3, 3, 2))
+        self.assertEqual(sweep['task_profile'], profiles)
+        for p, profile in enumerate(profiles):
+            for d, diameter in enumerate(diameters):
+                for c, contrast in enumerate(contrasts):
+                    dprime = calculate_dprime(self.nps, self.ttf, dict(params, task_profile=profile,
+                                                                       task_diameter_mm=diameter,
+                                                                       task_contrast_hu=contrast))
+                    self.assertGreater(dprime, 0)
+                    self.assertAlmostEqual(sweep['dprime'][p, d, c], dprime, delta=1e-9 * dprime)
+        # same path as calculate_dprime() with radial resampling
+        params = dict(params, nps_resampling='radial')
+        sweep = calculate_dprime_sweep(self.nps, self.ttf, [0.5, 5], [15], profiles, params)
+        for p, profile in enumerate(profiles):
+            for d, diameter in enumerate([0.5, 5]):
+                dprime = calculate_dprime(self.nps, self.ttf, dict(params, task_profile=profile,
+                                                                   task_diameter_mm=diameter))
+                self.assertAlmostEqual(sweep['dprime'][p, d, 0], dprime, delta=1e-9 * dprime)
+
+    def test_dprime_radial(self):
+        for profile in ['Flat', 'Gaussian', 'Ogive']:
+            for view_model in ['NPW', 'NPWE']:
+                params = dict(get_dprime_default_params(), task_profile=profile, view_model=view_model,
+                              task_diameter_mm=5, nps_resampling='radial')
+                dprime_radial = calculate_dprime(self.nps, self.ttf, params)
+                # same calculation on the 2D grid
+                data_freq = get_data_freq(self.nps, self.ttf)
+                freq_1d = np.fft.fftshift(np.fft.fftfreq(params['task_pixel_number'], params['task_pixel_size_mm']))
+                dprime_2d = calculate_dprime_from_spectra(calculate_task_freq(calculate_task_image(params), params),
+                                                          resample_2d_ttf(data_freq, self.ttf, freq_1d),
+                                                          resample_2d_nps(data_freq, self.nps, freq_1d, 'radial'),
+                                                          get_eye_filter(params, freq_1d), params)
+                self.assertAlmostEqual(dprime_radial, dprime_2d, delta=0.02 * dprime_2d)
+
+    def test_nps_resampling_cache(self):
+        clear_nps_resampling_cache()
+        data_freq = get_data_freq(self.nps, self.ttf)
+        freq_1d = np.fft.fftshift(np.fft.fftfreq(300, 0.05))
+        nps_spline = resample_2d_nps(data_freq, self.nps, freq_1d)
+        self.assertIs(resample_2d_nps(data_freq, self.nps, freq_1d), nps_spline)
+        self.assertIsNot(resample_2d_nps(data_freq, self.nps, freq_1d[:-1]), nps_spline)
+        self.assertFalse(nps_spline.flags.writeable)
+        # a new result with equal values is a different NPS
+        self.assertIsNot(resample_2d_nps(data_freq, dict(self.nps, nps_2d=list(self.nps['nps_2d'])), freq_1d),
+                         nps_spline)
+        nps_linear = resample_2d_nps(data_freq, self.nps, freq_1d, mode='linear')
+        self.assertAlmostEqual(np.sum(nps_linear), np.sum(nps_spline), delta=1e-6 * np.sum(nps_spline))
+        self.assertLess(np.max(np.abs(nps_linear - nps_spline)), 0.05 * np.max(nps_spline))
+        # shared by threads, also while entries are evicted
+        nps_results = [synthetic_nps(noise=5 + i) for i in range(8)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            sums = list(executor.map(lambda nps: np.sum(resample_2d_nps(data_freq, nps, freq_1d, mode='linear')),
+                                     nps_results * 20))
+        self.assertEqual(sums, [np.sum(resample_2d_nps(data_freq, nps, freq_1d, mode='linear'))
+                                for nps in nps_results] * 20)
+
+    def test_dprime_table(self):
+        diameters = ['d160mm', 'd260mm', 'd360mm']
+        nps_results = {d: synthetic_nps(noise=8 + 2 * i) for i, d in enumerate(diameters)}
+        ttf_results = {'Bone': {d: self.ttf for d in diameters}, 'Water': {d: synthetic_ttf(0.3) for d in diameters}}
+        params = dict(get_dprime_default_params(), nps_resampling='radial')
+        table = calculate_dprime_table(nps_results, ttf_results, params, max_workers=2)
+        self.assertEqual(len(table), 6)
+        for row in table:
+            self.assertAlmostEqual(row['dprime'], calculate_dprime(nps_results[row['section']],
+                                                                   ttf_results[row['insert']][row['section']],
+                                                                   dict(params, task_contrast_hu=100.0)))
+        values_dprime = get_values_dprime(table)
+        self.assertEqual(list(values_dprime['Bone']['dprimes'].keys()), diameters)
+        self.assertLess(values_dprime['Bone']['beta'], 0)  # noisier sections, lower d'
+        # series of sections
+        table = calculate_dprime_table({('B30', d): nps for d, nps in nps_results.items()},
+                                       {'Bone': {('B30', d): self.ttf for d in diameters}}, params, max_workers=1)
+        self.assertEqual(list(get_values_dprime(table)[('B30',)]['Bone']['dprimes'].keys()), diameters)
+
+    def test_dprime_fit(self):  # imQuest reference values
+        for insert, reference in load_test_data()['values_dprime'].items():
+            diameters_mm = [int(diameter_key[1:-2]) for diameter_key in reference['dprimes']]
+            fit = fit_dprime_vs_diameter(diameters_mm, list(reference['dprimes'].values()))
+            for key in ['alpha', 'beta', 'residual', 'r2']:
+                self.assertAlmostEqual(fit[key], reference[key], delta=1e-3 * abs(reference[key]))
+        # too few diameters for the least squares: exact fit or NaN, the keys are always there
+        fit = fit_dprime_vs_diameter([160, 260], [20.0, 10.0])
+        self.assertAlmostEqual(fit['alpha'] * np.exp(fit['beta'] * 160), 20.0)
+        self.assertAlmostEqual(fit['alpha'] * np.exp(fit['beta'] * 260), 10.0)
+        self.assertEqual((fit['residual'], fit['r2']), (0.0, 1.0))
+        fit = fit_dprime_vs_diameter([260], [10.0])
+        self.assertTrue(all(np.isnan(fit[key]) for key in ['alpha', 'beta', 'residual', 'r2']))
+
+
+if __name__ == '__main__':
+    unittest.main()
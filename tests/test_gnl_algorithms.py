@@ -0,0 +1,184 @@
+import numpy as np
+import unittest
+from actilib.analysis.gnl import calculate_local_std, calculate_local_std_by_label, calculate_gnl_by_tissue, \
+    calculate_gnl, calculate_volume_gnl, LocalStdHistogram, calculate_gnl_kernel_sweep, \
+    calculate_slice_gnl_histograms, calculate_local_std_tiled, calculate_slice_gnl
+from actilib.analysis.segmentation import SegMats, get_default_segmentation_thresholds
+
+
+class TestGNLAlgorithms(unittest.TestCase):
+    rng = np.random.default_rng(1234)
+    image = 40 + 10 * rng.standard_normal((96, 80))
+    image[30:60, 20:50] += 1000  # a sharp edge to check the numerical stability
+
+    def test_local_std_integral_image(self):
+        for kernel_size in [3, 9, 31]:
+            reference = calculate_local_std(self.image, kernel_size, 'convolution')
+            img_std = calculate_local_std(self.image, kernel_size, 'integral_image')
+            self.assertEqual(img_std.shape, self.image.shape)
+            self.assertTrue(np.allclose(img_std, reference, atol=1e-6))
+        img_std = calculate_local_std(self.image.astype(np.float32), 9, 'integral_image')
+        self.assertEqual(img_std.dtype, np.float32)
+        self.assertTrue(np.allclose(img_std, calculate_local_std(self.image, 9, 'convolution'), atol=1e-3))
+
+    def test_even_kernel(self):  # e.g. 3 mm at 0.7 mm: 10 pixels, aligned as by convolve2d(mode='same')
+        header = type('obj', (object,), {'PixelSpacing': [0.7, 0.7]})
+        image = {'pixels': self.image, 'header': header}
+        for kernel_size in [4, 10]:
+            reference = calculate_local_std(self.image, kernel_size, 'convolution')
+            self.assertTrue(np.allclose(calculate_local_std(self.image, kernel_size, 'integral_image'), reference,
+                                        atol=1e-6))
+            img_std = calculate_local_std(self.image, kernel_size, 'sliding_window_view')
+            self.assertEqual(img_std.shape, self.image.shape)
+            inner = (slice(kernel_size, -kernel_size), slice(kernel_size, -kernel_size))
+            self.assertTrue(np.allclose(img_std[inner], reference[inner], atol=1e-6))
+        self.assertAlmostEqual(calculate_gnl(image)[0], calculate_gnl(image, algorithm='convolution')[0], delta=1)
+        segmap = np.where(self.image > 500, SegMats.BONE.value, SegMats.SOFT_TISSUE.value)
+        img_std = calculate_local_std_by_label(self.image, segmap, [SegMats.SOFT_TISSUE.value], 10)
+        img_pad = np.pad(self.image, 5, mode='symmetric')
+        seg_pad = np.pad(segmap, 5, mode='symmetric')
+        for y, x in [(0, 0), (29, 25), (95, 79)]:  # window from 5 pixels before to 4 pixels after the center
+            window = img_pad[y:y + 10, x:x + 10][seg_pad[y:y + 10, x:x + 10] == SegMats.SOFT_TISSUE.value]
+            self.assertAlmostEqual(img_std[0][y, x], np.std(window), delta=1e-6)
+        self.assertAlmostEqual(calculate_gnl(image, algorithm='masked_integral_image')[0], 10, delta=2)
+        volume_gnl = calculate_volume_gnl([image, image], max_workers=1)
+        self.assertEqual(volume_gnl['gnl'][SegMats.SOFT_TISSUE][0], calculate_gnl(image, kernel_radius_mm=3,
+                                                                                  algorithm='masked_integral_image')[0])
+        for tissues in [None, [None]]:  # no segmentation, as in calculate_gnl()
+            volume_gnl = calculate_volume_gnl([image, image], tissues, algorithm='integral_image', max_workers=1)
+            self.assertEqual(volume_gnl['gnl'][None], [calculate_gnl(image, tissues)[0]] * 2)
+        sweep = calculate_gnl_kernel_sweep(image, [2, 3, 8])  # the largest kernel is even too
+        self.assertEqual(sweep['kernel_size_px'], [7, 10, 24])
+        for k, radius in enumerate(sweep['kernel_radius_mm']):
+            self.assertEqual(sweep['gnl'][SegMats.SOFT_TISSUE][k],
+                             calculate_gnl(image, kernel_radius_mm=radius, algorithm='masked_integral_image')[0])
+
+    def test_local_std_tiled(self):
+        for algorithm in ['sliding_window_view', 'convolution', 'generic_filter']:
+            for kernel_size in [7, 6]:
+                reference = calculate_local_std(self.image, kernel_size, algorithm)
+                for tile_size, max_workers in [(16, 1), (25, 3), (200, 1)]:
+                    img_std = calculate_local_std(self.image, kernel_size, algorithm, tile_size=tile_size,
+                                                  max_workers=max_workers)
+                    self.assertTrue(np.array_equal(img_std, reference, equal_nan=True))
+        image = np.round(self.image)  # CT numbers: the summed-area tables are exact
+        for kernel_size in [31, 10]:
+            reference = calculate_local_std(image, kernel_size, 'integral_image')
+            img_std = calculate_local_std_tiled(np.stack([image, image]), kernel_size, 'integral_image', tile_size=20)
+            self.assertTrue(np.array_equal(img_std[1], reference))
+
+    def test_local_std_by_label(self):
+        segmap = np.where(self.image > 500, SegMats.BONE.value, SegMats.SOFT_TISSUE.value)
+        kernel_size = 7
+        img_std = calculate_local_std_by_label(self.image, segmap, [SegMats.SOFT_TISSUE.value, SegMats.BONE.value],
+                                               kernel_size)
+        self.assertEqual(img_std.shape, (2,) + self.image.shape)
+        self.assertTrue(np.all(np.isnan(img_std[0][segmap == SegMats.BONE.value])))
+        # brute force on the pixels of the same label inside the kernel (symmetric padding as in the algorithm)
+        margin = kernel_size // 2
+        img_pad = np.pad(self.image, margin, mode='symmetric')
+        seg_pad = np.pad(segmap, margin, mode='symmetric')
+        for y, x in [(0, 0), (29, 25), (30, 20), (45, 49), (95, 79)]:
+            window = img_pad[y:y + kernel_size, x:x + kernel_size]
+            label = segmap[y, x]
+            expected = np.std(window[seg_pad[y:y + kernel_size, x:x + kernel_size] == label])
+            self.assertAlmostEqual(img_std[0 if label == SegMats.SOFT_TISSUE.value else 1][y, x], expected, delta=1e-6)
+        # border pixels do not see the edge anymore: the modes are close to the noise level
+        results = calculate_gnl_by_tissue(self.image, segmap, [SegMats.SOFT_TISSUE, SegMats.BONE], kernel_size)
+        self.assertAlmostEqual(results[SegMats.SOFT_TISSUE]['gnl'], 10, delta=2)
+        self.assertAlmostEqual(results[SegMats.BONE]['gnl'], 10, delta=2)
+
+    def test_volume_gnl(self):
+        header = type('obj', (object,), {'PixelSpacing': [0.5, 0.5], 'SliceLocation': 0})
+        images = []
+        for z in range(4):
+            pixels = 40 + (5 + z) * self.rng.standard_normal((64, 64))
+            pixels[:, :20] = -100  # fat
+            images.append({'pixels': pixels, 'header': type('obj', (header,), {'SliceLocation': 2.5 * z})})
+        copies = [image['pixels'].copy() for image in images]
+        tissues = [SegMats.SOFT_TISSUE, SegMats.LUNGS]
+        volume_gnl = calculate_volume_gnl(images, tissues, kernel_radius_mm=2, mask_rois=[[0, 10, 0, 10, 1000]],
+                                          max_workers=2, use_threads=True)
+        self.assertEqual(volume_gnl['z'], [0, 2.5, 5, 7.5])
+        self.assertEqual(len(volume_gnl['gnl'][SegMats.SOFT_TISSUE]), 4)
+        self.assertTrue(np.all(np.isnan(volume_gnl['gnl'][SegMats.LUNGS])))
+        for z in range(4):
+            self.assertAlmostEqual(volume_gnl['gnl'][SegMats.SOFT_TISSUE][z], 5 + z, delta=1.5)
+            self.assertTrue(np.array_equal(images[z]['pixels'], copies[z]))  # the caller's pixels are untouched
+        serial_gnl = calculate_volume_gnl(iter(images), tissues, kernel_radius_mm=2, mask_rois=[[0, 10, 0, 10, 1000]],
+                                          max_workers=1)
+        self.assertEqual(serial_gnl['gnl'][SegMats.SOFT_TISSUE], volume_gnl['gnl'][SegMats.SOFT_TISSUE])
+        self.assertAlmostEqual(volume_gnl['gnl_exam'][SegMats.SOFT_TISSUE], 6.5, delta=1.5)
+        self.assertTrue(np.isnan(volume_gnl['gnl_exam'][SegMats.LUNGS]))
+        calculate_gnl(images, mask_rois=[[0, 10, 0, 10, 1000]])
+        self.assertTrue(np.array_equal(images[0]['pixels'], copies[0]))
+
+    def test_local_std_histogram(self):
+        histogram = LocalStdHistogram(bin_width=0.5, max_value=10)
+        histogram.add_values([0.1, 2.2, 2.3, np.nan, 12, -1])
+        self.assertEqual(histogram.num_values(), 3)
+        self.assertEqual(histogram.num_outside, 2)
+        self.assertEqual(histogram.mode(), 2.25)
+        histogram.merge(LocalStdHistogram(bin_width=0.5, max_value=10).add_values([7.1, 7.2, 7.3]))
+        self.assertEqual(histogram.mode(), 7.25)
+        with self.assertRaises(ValueError):
+            histogram.merge(LocalStdHistogram(bin_width=1, max_value=10))
+        self.assertTrue(np.isnan(LocalStdHistogram().mode()))
+        histogram = LocalStdHistogram().add_values([1e19, -1e19, 0, 3.5])  # no overflow in the bin indexes
+        self.assertEqual((histogram.num_values(), histogram.num_outside), (1, 3))
+
+    def test_gnl_histogram_range(self):  # local SD above 1000 HU (e.g. metal) are not dropped by default
+        header = type('obj', (object,), {'PixelSpacing': [0.5, 0.5]})
+        pixels = 4000 + 1500 * self.rng.standard_normal((64, 64))
+        image = {'pixels': pixels, 'header': header}
+        gnl = calculate_gnl(image, SegMats.METAL, algorithm='convolution')[0]
+        self.assertAlmostEqual(gnl, 1300, delta=300)
+        self.assertTrue(np.isnan(calculate_gnl(image, SegMats.METAL, algorithm='convolution',
+                                               histogram_max_value=1000)[0]))
+        gnl = calculate_gnl(image, SegMats.METAL, algorithm='convolution', histogram_bin_width=10)[0]
+        self.assertEqual(gnl % 10, 5)  # center of a 10 HU bin
+        image = {'pixels': self.image, 'header': header}
+        self.assertTrue(np.isnan(calculate_gnl(image, SegMats.LUNGS)[0]))  # empty map
+
+    def test_gnl_mode_convention(self):  # single slices and volumes give the same GNL
+        header = type('obj', (object,), {'PixelSpacing': [0.5, 0.5]})
+        images = [{'pixels': self.image + 0.0, 'header': header}, {'pixels': 2 * self.image, 'header': header}]
+        volume_gnl = calculate_volume_gnl(images, kernel_radius_mm=2, algorithm='masked_integral_image', max_workers=1)
+        for image, gnl in zip(images, volume_gnl['gnl'][SegMats.SOFT_TISSUE]):
+            self.assertEqual(calculate_gnl(image, kernel_radius_mm=2, algorithm='masked_integral_image')[0], gnl)
+
+    def test_gnl_kernel_sweep(self):
+        header = type('obj', (object,), {'PixelSpacing': [0.5, 0.5]})
+        image = {'pixels': self.image, 'header': header}
+        tissues = [SegMats.SOFT_TISSUE, SegMats.METAL]
+        sweep = calculate_gnl_kernel_sweep(image, [1, 2, 4], tissues)
+        self.assertEqual(sweep['kernel_size_px'], [5, 9, 17])
+        for k, radius in enumerate(sweep['kernel_radius_mm']):
+            histograms = calculate_slice_gnl_histograms(self.image, 0.5, tissues, radius,
+                                                        get_default_segmentation_thresholds(), None,
+                                                        'masked_integral_image')
+            for tissue in tissues:
+                self.assertFalse(np.isnan(sweep['gnl'][tissue][k]))
+                self.assertEqual(sweep['gnl'][tissue][k], histograms[tissue].mode())
+
+    def test_body_mask(self):
+        yy, xx = np.mgrid[:120, :120]
+        body = (yy - 55) ** 2 + (xx - 60) ** 2 < 45 ** 2
+        pixels = np.where(body, 40 + 10 * self.rng.standard_normal((120, 120)), -1000)
+        pixels[112:118, 5:115] = 40 + 50 * self.rng.standard_normal((6, 110))  # noisy "table" in soft tissue range
+        tissues = [SegMats.SOFT_TISSUE]
+        args = (pixels, 0.5, tissues, 1.5, get_default_segmentation_thresholds(), None, 'masked_integral_image')
+        gnl, _, segmap, gnlmap = calculate_slice_gnl(*args, body_mask=True)
+        self.assertFalse(np.any(segmap[~body] == SegMats.SOFT_TISSUE.value))
+        self.assertFalse(np.any(gnlmap[~body]))
+        self.assertTrue(abs(gnl - 10) <= 2)
+        no_table = np.where(body, pixels, -1000)
+        _, _, segmap_ref, gnlmap_ref = calculate_slice_gnl(no_table, *args[1:])
+        self.assertTrue(np.array_equal(segmap, segmap_ref))
+        self.assertTrue(np.allclose(gnlmap, gnlmap_ref))
+        histograms = calculate_slice_gnl_histograms(*args, body_mask=True)
+        self.assertEqual(histograms[SegMats.SOFT_TISSUE].num_values(), np.count_nonzero(segmap_ref == 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
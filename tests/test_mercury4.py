@@ -0,0 +1,112 @@
+import copy
+import numpy as np
+import os
+import pkg_resources
+import tempfile
+import unittest
+from actilib.helpers.io import load_images_from_tar
+from actilib.helpers.imquest import get_dprime_table, plot_dprime_vs_size
+from actilib.phantoms.mercury4 import classify_slices, find_phantom_center_and_radius, analyze_mercury_phantom, \
+    find_ring_inserts, verify_section_inserts, get_geometry_cache_path, load_phantom_geometry
+
+
+class TestMercury4(unittest.TestCase):
+    def load(self, filename):
+        tarpath = pkg_resources.resource_filename('actilib', os.path.join('resources', filename))
+        return load_images_from_tar(tarpath)
+
+    def test_classify_slices(self):
+        self.assertEqual(''.join(classify_slices(self.load('dicom_nps.tar.xz'))), 'x' + 'N' * 15)
+        self.assertEqual(''.join(classify_slices(self.load('dicom_ttf.tar.xz'))), 'T' * 15)
+        images = self.load('dicom_not.tar.xz')
+        flags, centers_xy, radii_px = classify_slices(images, max_workers=2, use_threads=True, return_geometry=True)
+        self.assertEqual(''.join(flags), 'xxxxxNxNNxxTxxxxxxx')
+        self.assertEqual(len(centers_xy), len(images))
+        center_xy, radius_px, _, _ = find_phantom_center_and_radius(images[5])
+        self.assertAlmostEqual(centers_xy[5][0], center_xy[0])
+        self.assertAlmostEqual(centers_xy[5][1], center_xy[1])
+        self.assertAlmostEqual(radii_px[5], radius_px)
+
+    def test_classify_slices_sparse(self):
+        for filename in ['dicom_nps.tar.xz', 'dicom_ttf.tar.xz']:
+            images = self.load(filename)
+            flags, centers_xy, _ = classify_slices(images, return_geometry=True, sampling_mm=6.4)  # every 4 images
+            self.assertEqual(flags, classify_slices(images))
+            self.assertLess(sum(center_xy is not None for center_xy in centers_xy), len(images) / 2)
+        nps_images = self.load('dicom_nps.tar.xz')
+        images = []  # x N..N T..T N..N x, on a regular grid of 1.6 mm
+        for z, image in enumerate(nps_images + self.load('dicom_ttf.tar.xz') + nps_images[::-1]):
+            header = copy.copy(image['header'])
+            header.ImagePositionPatient = [0, 0, 1.6 * z]
+            images.append({'pixels': image['pixels'], 'header': header})
+        reference = classify_slices(images)
+        self.assertEqual(''.join(reference), 'x' + 'N' * 15 + 'T' * 15 + 'N' * 15 + 'x')
+        for sampling_mm in [3.3, 6.5, 16.1]:  # every 2, 4 and 10 images
+            flags, centers_xy, _ = classify_slices(images, return_geometry=True, sampling_mm=sampling_mm)
+            self.assertEqual(flags, reference)
+            self.assertLess(sum(center_xy is not None for center_xy in centers_xy), len(images))
+
+    def test_find_ring_inserts(self):
+        images = self.load('dicom_ttf.tar.xz')
+        center_xy, _, _, _ = find_phantom_center_and_radius(images[0])
+        pixel_size_xy_mm = images[0]['header'].PixelSpacing
+        batch = find_ring_inserts(np.stack([image['pixels'] for image in images]), center_xy, pixel_size_xy_mm)
+        self.assertEqual(len(batch), len(images))
+        inserts = find_ring_inserts(images[0]['pixels'], center_xy, pixel_size_xy_mm)
+        self.assertEqual(sorted(inserts.keys()), ['air', 'bone', 'iodine', 'polystyrene', 'water'])
+        for name, xyr in inserts.items():
+            self.assertTrue(np.allclose(xyr, batch[0][name]))
+        self.assertTrue(np.allclose(inserts['bone'][:2], [304.4, 292.5], atol=0.5))  # from the contours of the insert
+        self.assertTrue(np.allclose(inserts['air'][:2], [242.7, 200.2], atol=0.5))
+        self.assertIsNone(find_ring_inserts(self.load('dicom_nps.tar.xz')[5]['pixels'], center_xy, pixel_size_xy_mm))
+
+    def test_analyze_mercury_phantom(self):
+        images = self.load('dicom_nps.tar.xz') + self.load('dicom_ttf.tar.xz')
+        images.sort(key=lambda image: float(image['header'].ImagePositionPatient[2]))
+        results = analyze_mercury_phantom(images, max_workers=1)
+        self.assertEqual(results['info_phantom']['diameters_mm'], [260])
+        self.assertEqual(sum(results['values_slices']['is_nps']), 15)
+        self.assertEqual(sum(results['values_slices']['is_ttf']), 15)
+        self.assertEqual(list(results['values_nps'].keys()), ['d260mm'])
+        self.assertAlmostEqual(results['values_nps']['d260mm']['noise'], 11, delta=1)
+        self.assertEqual(sorted(results['values_ttf'].keys()), ['Air', 'Bone', 'Iodine', 'Polystyrene', 'Water'])
+        for insert, contrast in {'Bone': 880, 'Air': -970, 'Iodine': 260}.items():
+            self.assertAlmostEqual(results['values_ttf'][insert]['d260mm']['contrast'], contrast, delta=20)
+        self.assertEqual(sorted(results['values_dprime'].keys()), sorted(results['values_ttf'].keys()))
+        self.assertEqual(len(results['values_profile']['wed']), len(images))
+        # the results can be rendered as those of imQuest
+        self.assertEqual(len(get_dprime_table(results)), 5)
+        plot_dprime_vs_size(results)
+
+    def test_phantom_geometry_cache(self):
+        images = self.load('dicom_nps.tar.xz') + self.load('dicom_ttf.tar.xz')
+        images.sort(key=lambda image: float(image['header'].ImagePositionPatient[2]))
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results, geometry = analyze_mercury_phantom(images, max_workers=1, geometry_cache_dir=cache_dir,
+                                                        return_geometry=True)
+            self.assertEqual(load_phantom_geometry(get_geometry_cache_path(cache_dir, images[0]['header'])), geometry)
+            self.assertEqual(list(geometry['nps'].keys()), ['d260mm'])
+            self.assertEqual(len(geometry['nps']['d260mm']['rois']), 4)
+            section = geometry['ttf']['d260mm']
+            self.assertEqual(sorted(section['insert_angles_deg']), ['air', 'bone', 'iodine', 'polystyrene', 'water'])
+            cached = analyze_mercury_phantom(images, max_workers=1, geometry_cache_dir=cache_dir)
+        self.assertEqual(cached['values_slices'], results['values_slices'])
+        for insert, ttf in results['values_ttf'].items():
+            self.assertAlmostEqual(cached['values_ttf'][insert]['d260mm']['contrast'], ttf['d260mm']['contrast'])
+        self.assertAlmostEqual(cached['values_nps']['d260mm']['noise'], results['values_nps']['d260mm']['noise'])
+        # verification: inserts where expected, and nowhere else
+        ttf_image = images[-1]
+        center_xy = section['center_xy']
+        self.assertTrue(verify_section_inserts(ttf_image, section, center_xy))
+        self.assertFalse(verify_section_inserts(images[5], section, center_xy))
+        rotated = copy.deepcopy(geometry)
+        names, angles_deg = list(section['insert_angles_deg'].keys()), list(section['insert_angles_deg'].values())
+        rotated['ttf']['d260mm']['insert_angles_deg'] = dict(zip(names[1:] + names[:1], angles_deg))  # swapped
+        self.assertFalse(verify_section_inserts(ttf_image, rotated['ttf']['d260mm'], center_xy))
+        fallback = analyze_mercury_phantom(images, max_workers=1, phantom_geometry=rotated)
+        self.assertAlmostEqual(fallback['values_ttf']['Bone']['d260mm']['contrast'],
+                               results['values_ttf']['Bone']['d260mm']['contrast'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,8 @@ import pkg_resources
 import unittest
 from actilib.helpers.io import load_images_from_tar
 from actilib.phantoms.mercury4 import find_phantom_center_and_radius
-from actilib.analysis.nps import noise_properties
+from actilib.analysis.nps import noise_properties, find_nps_rois, find_uniform_rois
+from actilib.analysis.segmentation import SegMats
 from actilib.analysis.rois import SquareROI
 
 
@@ -49,6 +50,25 @@ class TestNPS(unittest.TestCase):
         self.assertAlmostEqual(nps['fmean'], 0.21, delta=0.01)
         self.assertAlmostEqual(max(nps['nps_1d']), 300, delta=10)
 
+    def test_nps_with_automatic_rois(self):
+        self.load('dicom_nps.tar.xz')
+        rois = find_nps_rois(self.images, 64, tissue=SegMats.FAT)  # phantom background is around -65 HU
+        self.assertEqual(len(rois), len(self.images))
+        for roi in rois:
+            self.assertEqual(roi.size(), 64)
+            cropped = roi.get_cropped_image(self.images[0]['pixels'])
+            self.assertTrue(-300 < np.min(cropped) and np.max(cropped) < 0)
+        nps = noise_properties(self.images, rois, fft_samples=128)
+        self.assertAlmostEqual(nps['huavg'], -64, delta=4)
+        self.assertAlmostEqual(nps['noise'], 9.5, delta=1)  # the least noisy regions are selected
+        with self.assertRaises(ValueError):
+            noise_properties(self.images, rois[:-1])
+        with self.assertRaises(ValueError):
+            noise_properties(self.images, [None] * len(self.images))
+        rois = find_uniform_rois(self.images[0]['pixels'], [400, 96, 64], 3, tissue=SegMats.FAT)
+        self.assertEqual([roi.size() for roi in rois], [96] * 3)
+        self.assertEqual(find_uniform_rois(self.images[0]['pixels'], 64, tissue=SegMats.BONE), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,51 @@
+import numpy as np
+import os
+import pkg_resources
+import unittest
+from types import SimpleNamespace
+from actilib.analysis.profile import get_effective_mas, get_tube_current_profile, calculate_wed, \
+    calculate_scout_image, get_exposure_values
+from actilib.helpers.io import load_headers_from_tar, load_images_from_tar
+
+
+class TestProfile(unittest.TestCase):
+    def test_tube_current_profile(self):
+        headers = [SimpleNamespace(XRayTubeCurrent=200, RevolutionTime=0.5, SpiralPitchFactor=0.8),
+                   SimpleNamespace(XRayTubeCurrent=300, ExposureTime=500)]
+        self.assertAlmostEqual(get_effective_mas(headers[0]), 125)
+        self.assertAlmostEqual(get_effective_mas(headers[1]), 150)
+        profile = get_tube_current_profile(headers)
+        self.assertEqual(profile['label'], 'Effective mAs')
+        self.assertEqual(profile['limits'], [0, 800])
+        profile = get_tube_current_profile([SimpleNamespace(CTDIvol=12.5), SimpleNamespace(CTDIvol=8)])
+        self.assertEqual(profile['values'], [12.5, 8])
+        self.assertEqual(profile['limits'], [0, 50])
+
+    def test_wed_and_scout(self):
+        yy, xx = np.mgrid[:256, :256]
+        image = np.full((256, 256), -1000.0)
+        image[(yy - 128) ** 2 + (xx - 128) ** 2 < 100 ** 2] = 0  # water disk, 100 mm of radius
+        self.assertAlmostEqual(calculate_wed(image, [1, 1]), 200, delta=1)
+        self.assertAlmostEqual(calculate_wed(image, [0.5, 0.5]), 100, delta=0.5)
+        volume = np.stack([image, np.full(image.shape, -1000.0), np.clip(image + 1000, None, 0)])
+        wed = calculate_wed(volume, [1, 1])
+        self.assertTrue(np.allclose(wed, [calculate_wed(pixels, [1, 1]) for pixels in volume]))
+        self.assertEqual(wed[1], 0)
+        scout = calculate_scout_image(np.stack([image, image - 500]))
+        self.assertEqual(scout.shape, (256, 2))
+        self.assertEqual(scout.min(), 0)
+        self.assertEqual(scout.max(), 1000)
+
+    def test_header_only_profile(self):
+        tarpath = pkg_resources.resource_filename('actilib', os.path.join('resources', 'dicom_not.tar.xz'))
+        headers = [image['header'] for image in load_headers_from_tar(tarpath)]
+        self.assertFalse(any('PixelData' in header for header in headers))
+        images = load_images_from_tar(tarpath)
+        self.assertEqual(get_tube_current_profile(headers), get_tube_current_profile([i['header'] for i in images]))
+        exposure = get_exposure_values(headers)
+        self.assertEqual(len(exposure['current_ma']), len(images))
+        self.assertEqual(exposure['ctdivol'], get_tube_current_profile(headers)['values'])
+
+
+if __name__ == '__main__':
+    unittest.main()
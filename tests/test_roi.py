@@ -1,6 +1,10 @@
+import copy
+import json
 import numpy as np
 import unittest
-from actilib.analysis.rois import SquareROI, CircleROI, get_surrounding_sum, get_surrounding_average
+from actilib.analysis.rois import SquareROI, CircleROI, RoiSet, get_surrounding_sum, get_surrounding_average, \
+    create_circle_of_rois, get_surrounding_averages, calculate_noise_map, roi_from_dict
+from actilib.helpers.math import get_integral_image, subtract_2d_poly_mean
 
 IMG_SIZE = 8
 ROI_RADI = IMG_SIZE / 2.0
@@ -58,6 +62,139 @@ class TestROIs(unittest.TestCase):
         self.assertEqual(get_surrounding_sum(self.image, roi, ROI_RADI), 20)
         self.assertAlmostEqual(get_surrounding_average(self.image, roi, ROI_RADI), 0.625, delta=0.01)
 
+    def test_bbox_masks(self):
+        rng = np.random.default_rng(0)
+        image = rng.standard_normal((40, 50))
+        grid_y, grid_x = np.ogrid[:40, :50]
+        for center_x, center_y, radius in rng.uniform([-5, -5, 0.5], [55, 45, 12], (50, 3)):
+            dist = np.sqrt((grid_x - center_x) ** 2 + (grid_y - center_y) ** 2)
+            roi = CircleROI(radius, center_x, center_y)
+            expected = (dist <= radius) & (dist >= radius / 2)
+            self.assertTrue(np.array_equal(roi.get_annular_mask(image, radius / 2), expected))
+            self.assertEqual(roi.get_area(image), np.count_nonzero(dist <= radius))
+            self.assertAlmostEqual(roi.get_masked_sum(image), np.sum(image[dist <= radius]))
+            roi = SquareROI(2 * radius, center_x, center_y)
+            expected = np.zeros(image.shape, dtype=bool)
+            expected[max(0, int(np.floor(center_y - radius + 0.5))):max(0, int(np.floor(center_y + radius + 0.5))),
+                     max(0, int(np.floor(center_x - radius + 0.5))):max(0, int(np.floor(center_x + radius + 0.5)))] = 1
+            self.assertTrue(np.array_equal(roi.get_mask(image), expected))
+            self.assertAlmostEqual(roi.get_masked_sum(image), np.sum(image[expected]))
+            self.assertTrue(np.array_equal(roi.get_masked_image(image), np.where(expected, image, 0)))
+        # square annulus: the inner box is excluded
+        roi = SquareROI(6, 10, 10)
+        mask = roi.get_annular_mask(image, radius_inner=1)
+        self.assertEqual(np.sum(mask), 36 - 4)
+        self.assertEqual(np.sum(mask[9:11, 9:11]), 0)
+        # masks are shared by ROIs with the same sub-pixel position
+        mask = CircleROI(5, 10.25, 20.5).get_bbox_mask()[1]
+        self.assertIs(mask, CircleROI(5, 30.25, 5.5).get_bbox_mask()[1])
+        self.assertFalse(mask.flags.writeable)
+        self.assertTrue(np.shares_memory(CircleROI(5, 10.25, 20.5).get_crop_and_mask(image)[0], image))
+
+    def test_cropped_image(self):
+        rng = np.random.default_rng(1)
+        stack = rng.standard_normal((3, 30, 40))
+        for roi in [SquareROI(10, 20.3, 12.6), CircleROI(6, 18, 14.5), CircleROI(5.5, 20.2, 15.7)]:
+            [y1, y2, x1, x2] = roi.indexes_tblr()
+            mask = roi.get_mask().astype(bool)
+            for image in stack:  # same result as masking the whole image before cropping
+                expected = np.ma.masked_where(~mask, np.multiply(image, roi.get_mask(image))[y1:y2, x1:x2])
+                cropped = roi.get_cropped_image(image)
+                self.assertTrue(np.array_equal(cropped.data, expected.data))
+                self.assertTrue(np.array_equal(np.ma.getmaskarray(cropped), np.ma.getmaskarray(expected)))
+            cropped = roi.get_cropped_image(stack)
+            self.assertEqual(cropped.shape, (3, y2 - y1, x2 - x1))
+            self.assertTrue(np.array_equal(cropped[1], roi.get_cropped_image(stack[1])))
+        self.assertTrue(np.shares_memory(SquareROI(10, 20, 12).get_cropped_image(stack).data, stack))
+
+    def test_roi_set(self):
+        rng = np.random.default_rng(2)
+        stack = rng.standard_normal((2, 40, 50))
+        rois = create_circle_of_rois(8, 9, 15, 25, 20, 10, 'circle') + create_circle_of_rois(5, 7.5, 12, 25, 20) + \
+            [SquareROI(12, 2.3, 37.8), CircleROI(6, 49, 1.5), SquareROI(4, -10, -10), CircleROI(0.2, 10.5, 10.5)]
+        roi_set = RoiSet.from_rois(rois)
+        self.assertEqual(len(roi_set), len(rois))
+        stats = roi_set.get_statistics(stack)
+        self.assertEqual(stats['mean'].shape, (2, len(rois)))
+        for i, roi in enumerate(roi_set.to_rois()):
+            self.assertEqual({**roi.as_dict(), 'Name': None}, {**rois[i].as_dict(), 'Name': None})
+            self.assertEqual(stats['area'][i], roi.get_area(stack[0]))
+            for z, image in enumerate(stack):
+                crop, mask = roi.get_crop_and_mask(image)
+                if stats['area'][i] == 0:
+                    self.assertTrue(np.isnan(stats['mean'][z, i]))
+                    continue
+                self.assertAlmostEqual(stats['mean'][z, i], roi.get_masked_mean(image))
+                self.assertAlmostEqual(stats['std'][z, i], np.std(crop[mask]))
+                self.assertEqual(stats['min'][z, i], np.min(crop[mask]))
+                self.assertEqual(stats['max'][z, i], np.max(crop[mask]))
+        self.assertTrue(np.allclose(roi_set.get_statistics(stack[1])['mean'], stats['mean'][1], equal_nan=True))
+
+    def test_surrounding_with_integral_image(self):
+        rng = np.random.default_rng(3)
+        image = rng.integers(-100, 100, (40, 50)).astype(float)
+        sat = get_integral_image(image)
+        rois = create_circle_of_rois(6, 8, 14, 25, 20, 5) + create_circle_of_rois(4, 9, 20, 25, 20, 0, 'circle') + \
+            [SquareROI(10, 2, 3), SquareROI(7, 47.5, 38.2)]
+        for roi in rois:
+            # reference: the old implementation with two ROIs of different size
+            area_small, sum_small = roi.get_area(image), roi.get_masked_sum(image)
+            size = roi.size()
+            roi.set_size(size + 2 * 6)
+            area_large, sum_large = roi.get_area(image), roi.get_masked_sum(image)
+            roi.set_size(size)
+            self.assertAlmostEqual(get_surrounding_sum(image, roi, 6, sat), sum_large - sum_small)
+            self.assertAlmostEqual(get_surrounding_average(image, roi, 6, sat=sat),
+                                   (sum_large - sum_small) / (area_large - area_small))
+        averages = get_surrounding_averages(image, rois, 6, 2)
+        self.assertEqual(len(averages), len(rois))
+        self.assertAlmostEqual(averages[-1], get_surrounding_average(image, rois[-1], 6, 2))
+
+    def test_noise_map(self):
+        rng = np.random.default_rng(4)
+        grid_y, grid_x = np.mgrid[:50, :60]
+        image = -80 + 0.01 * (grid_x - 30) ** 2 + 0.5 * grid_y + 10 * rng.standard_normal((50, 60))
+        stack = np.stack([image, 2 * image])
+        for detrend in [False, True]:
+            noise_map = calculate_noise_map(stack, 11, step=3, detrend=detrend)
+            self.assertEqual(noise_map['std'].shape, (2, 14, 17))
+            for i_y, i_x in [(0, 0), (5, 9), (13, 16)]:
+                roi = SquareROI(11, noise_map['centers_x'][i_x], noise_map['centers_y'][i_y])
+                crop = roi.get_cropped_image(image).data
+                expected_std = np.std(subtract_2d_poly_mean(crop)) if detrend else np.std(crop)
+                self.assertAlmostEqual(noise_map['std'][0, i_y, i_x], expected_std, places=8)
+                self.assertAlmostEqual(noise_map['std'][1, i_y, i_x], 2 * expected_std, places=8)
+                self.assertAlmostEqual(noise_map['mean'][0, i_y, i_x], np.mean(crop), places=8)
+        noise_map = calculate_noise_map(image, 40, step=7, detrend=True)  # large ROIs, far from the image center
+        for i_y, i_x in [(0, 0), (1, 2)]:
+            crop = SquareROI(40, noise_map['centers_x'][i_x], noise_map['centers_y'][i_y]).get_cropped_image(image).data
+            self.assertAlmostEqual(noise_map['std'][i_y, i_x], np.std(subtract_2d_poly_mean(crop)), places=8)
+        self.assertRaises(ValueError, calculate_noise_map, image, 51)
+
+    def test_roi_copy_and_serialization(self):
+        roi = CircleROI(5, 10.5, 20, name='insert')
+        self.assertFalse(hasattr(roi, '__dict__'))
+        larger = roi.resized(2)
+        self.assertEqual((larger.size(), larger.center_x(), larger.name(), larger.shape()),
+                         (14, 10.5, 'insert', 'circle'))
+        self.assertEqual(roi.size(), 10)
+        for roi_copy in [roi.copy(), copy.copy(roi), copy.deepcopy(roi)]:
+            self.assertIsNot(roi_copy, roi)
+            self.assertEqual(roi_copy.as_dict(), roi.as_dict())
+        unnamed = SquareROI(8, 3, 4)
+        self.assertEqual(unnamed.name(), unnamed.name())
+        for shape in ['Circle', 'circle', 'SQUARE']:
+            self.assertEqual(roi_from_dict({**roi.as_dict(), 'Shape': shape}).shape(), shape.lower())
+        self.assertRaises(NotImplementedError, roi_from_dict, {**roi.as_dict(), 'Shape': 'star'})
+        rois = create_circle_of_rois(50, 9, 15, 25, 20, 10, 'circle') + [roi, unnamed]
+        roi_dicts = json.loads(json.dumps(RoiSet.from_rois(rois).as_dicts()))
+        for roi_dict, original in zip(roi_dicts, rois):
+            self.assertEqual({**roi_from_dict(roi_dict).as_dict(), 'Name': None}, {**original.as_dict(), 'Name': None})
+        self.assertEqual(roi_dicts[50]['Name'], 'insert')
+        roi_set = RoiSet.from_dicts(roi_dicts)
+        self.assertTrue(np.array_equal(roi_set.centers_x, [r.center_x() for r in rois]))
+        self.assertEqual(roi_set.to_rois()[50].as_dict(), roi.as_dict())
+
 
 if __name__ == '__main__':
     unittest.main()
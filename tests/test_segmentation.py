@@ -0,0 +1,54 @@
+import numpy as np
+import unittest
+from actilib.analysis.segmentation import SegMats, HU_RANGES, SEG_UNASSIGNED, segment_with_lut, \
+    get_body_mask, get_bounding_box
+
+
+class TestSegmentation(unittest.TestCase):
+    rng = np.random.default_rng(42)
+    image = rng.uniform(-1100, 3500, (2, 64, 48))
+
+    def reference_segmentation(self, image, hu_ranges):
+        segm = np.full(image.shape, SEG_UNASSIGNED, dtype=np.uint8)
+        for tissue, hu_range in hu_ranges.items():
+            segm[(hu_range[0] <= image) & (image < hu_range[1])] = tissue.value
+        return segm
+
+    def test_lut_default_ranges(self):
+        segm = segment_with_lut(self.image, HU_RANGES)
+        self.assertEqual(segm.dtype, np.uint8)
+        self.assertEqual(segm.shape, self.image.shape)
+        self.assertTrue(np.array_equal(segm, self.reference_segmentation(self.image, HU_RANGES)))
+        pixels = np.round(self.image[0]).astype(np.int16)
+        self.assertTrue(np.array_equal(segment_with_lut(pixels), self.reference_segmentation(pixels, HU_RANGES)))
+
+    def test_lut_bounds(self):
+        hu_ranges = {SegMats.LUNGS: [-800, -300], SegMats.FAT: [-300, 0], SegMats.CUSTOM: [-50, 50]}
+        pixels = np.array([-800.5, -800, -300.01, -300, -0.5, 0, 49.99, 50, np.nan])
+        expected = [SEG_UNASSIGNED, 1, 1, 2, SegMats.CUSTOM.value, SegMats.CUSTOM.value, SegMats.CUSTOM.value,
+                    SEG_UNASSIGNED, SEG_UNASSIGNED]
+        self.assertEqual(segment_with_lut(pixels, hu_ranges).tolist(), expected)
+        hu_ranges = {SegMats.SOFT_TISSUE: [-0.5, 100.5]}  # non-integer bounds: no lookup table
+        self.assertTrue(np.array_equal(segment_with_lut(self.image, hu_ranges),
+                                       self.reference_segmentation(self.image, hu_ranges)))
+
+    def test_body_mask(self):
+        yy, xx = np.mgrid[:128, :128]
+        image = np.full((128, 128), -1000.0)
+        image[(yy - 60) ** 2 + (xx - 64) ** 2 < 40 ** 2] = 40  # body
+        image[(yy - 60) ** 2 + (xx - 50) ** 2 < 10 ** 2] = -850  # lung
+        image[110:116, 10:118] = 200  # table
+        image[2:6, 2:20] = 1000  # annotation
+        mask = get_body_mask(image)
+        self.assertTrue(np.array_equal(mask, (yy - 60) ** 2 + (xx - 64) ** 2 < 40 ** 2))
+        self.assertEqual(get_bounding_box(mask), (slice(21, 100), slice(25, 104)))
+        self.assertEqual(get_bounding_box(mask, margin=30), (slice(0, 128), slice(0, 128)))
+        self.assertIsNone(get_bounding_box(get_body_mask(np.full((8, 8), -1000))))
+        volume = np.stack([image, np.roll(image, 5, axis=1)])
+        self.assertTrue(np.array_equal(get_body_mask(volume)[1], np.roll(mask, 5, axis=1)))
+        segm = segment_with_lut(image, HU_RANGES, mask=mask)
+        self.assertTrue(np.array_equal(segm, np.where(mask, segment_with_lut(image), SEG_UNASSIGNED)))
+
+
+if __name__ == '__main__':
+    unittest.main()